@@ -14,5 +14,6 @@ else:
 app, _ = init_app(db_url, develop=develop)
 mail = Mail(app)
 
-with app.app_context():
-    app.run(host='0.0.0.0', port=8000)
+if __name__ == '__main__':
+    with app.app_context():
+        app.run(host='0.0.0.0', port=8000)
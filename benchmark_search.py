@@ -0,0 +1,127 @@
+import argparse
+import json
+import platform
+from math import ceil
+from time import perf_counter
+
+from sqlalchemy import event
+
+from database import db
+from init_app import init_app
+from populate_synthetic import populate_synthetic
+from utils.reindex import reindex
+from utils.search_cache import search_cache
+
+# Variantes de /services/search medidas: (nombre, query string, json), todas paginadas
+variants = [
+    ('all', '?limit=20', None),
+    ('text', '', {'search_text': 'clases english', 'limit': 20}),
+    ('text_second_page', '', {'search_text': 'clases english', 'limit': 20, 'cursor': 20}),
+    ('text_bm25', '', {'search_text': 'clases english', 'ranking': 'bm25', 'limit': 20}),
+    ('text_prefix', '', {'search_text': 'progra', 'limit': 20}),
+    ('text_typo', '', {'search_text': 'guitr', 'limit': 20}),
+    ('hashtag', '', {'search_text': '#guitar', 'limit': 20}),
+    ('text_sort_price', '', {'search_text': 'garden', 'sort': {'by': 'price', 'reverse': False}, 'limit': 20}),
+    ('text_sort_popularity', '', {'search_text': 'garden', 'sort': {'by': 'popularity', 'reverse': True},
+                                  'limit': 20}),
+    ('filter_price', '', {'filters': {'price': {'min': 10, 'max': 50}}, 'limit': 20}),
+    ('filter_rating', '', {'filters': {'rating': {'min': 4}}, 'limit': 20}),
+    ('filter_popularity', '', {'filters': {'popularity': {'min': 2}}, 'limit': 20}),
+    ('text_filter_price', '', {'search_text': 'clases', 'filters': {'price': {'min': 10, 'max': 50}}, 'limit': 20}),
+    ('sort_creation_date', '', {'sort': {'by': 'creation_date', 'reverse': True}, 'limit': 20}),
+    ('text_facets', '', {'search_text': 'clases', 'facets': True, 'limit': 20}),
+    ('filter_facets', '', {'filters': {'price': {'min': 10}}, 'facets': True, 'limit': 20}),
+]
+
+
+def percentile(values, p):
+    """
+    :param values: measured values
+    :param p: percentile, between 0 and 100
+    :return: the nearest-rank percentile of the values
+    """
+    values = sorted(values)
+    return values[max(0, ceil(p / 100 * len(values)) - 1)]
+
+
+def run_variant(client, engine, query_string, body, repetitions):
+    """
+    Requests a search several times with the cache emptied before each request
+    :param client: test client of the app
+    :param engine: database engine, its statements are counted
+    :param query_string: query string of the request
+    :param body: json of the request or None
+    :param repetitions: number of requests
+    :return: dict with the latency percentiles in ms, the statements per request and the number of results
+    """
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements[-1] += 1
+
+    latencies = []
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        for _ in range(repetitions):
+            search_cache.bump_version()
+            statements.append(0)
+            start = perf_counter()
+            if body is None:
+                r = client.get("services/search" + query_string)
+            else:
+                r = client.get("services/search" + query_string, json=body)
+            latencies.append((perf_counter() - start) * 1000)
+            if r.status_code != 200:
+                raise RuntimeError(f"search failed with {r.status_code}: {r.get_data(as_text=True)[:200]}")
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+    results = r.get_json()
+    return {
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'mean_ms': round(sum(latencies) / len(latencies), 3),
+        'queries_per_request': round(sum(statements) / len(statements), 2),
+        'results': len(results['services'] if isinstance(results, dict) else results)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of /services/search over a synthetic catalog")
+    parser.add_argument('--database', default='sqlite:///benchmark.db', help="database used by the benchmark")
+    parser.add_argument('--users', type=int, default=10000, help="number of synthetic users")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the synthetic data")
+    parser.add_argument('--repetitions', type=int, default=50, help="requests per variant")
+    parser.add_argument('--reuse', action='store_true', help="use the data already in the database")
+    parser.add_argument('--output', default='bench_output.json', help="json file with the results")
+    args = parser.parse_args()
+
+    app, _ = init_app(args.database)
+    with app.app_context():
+        if not args.reuse:
+            db.drop_all()
+            counts = populate_synthetic(db, n_users=args.users, seed=args.seed)
+            reindex(batch_size=5000)
+        else:
+            counts = None
+
+        client = app.test_client()
+        results = {}
+        for name, query_string, body in variants:
+            results[name] = run_variant(client, db.engine, query_string, body, args.repetitions)
+            print(f"{name:24} p50 {results[name]['p50_ms']:9.2f} ms  p99 {results[name]['p99_ms']:9.2f} ms  "
+                  f"{results[name]['queries_per_request']:7.1f} queries  {results[name]['results']} results")
+
+    output = {
+        'meta': {'users': args.users, 'seed': args.seed, 'repetitions': args.repetitions, 'rows': counts,
+                 'search_engine': app.config['SEARCH_ENGINE'], 'search_backend': app.config['SEARCH_BACKEND'],
+                 'python': platform.python_version()},
+        'variants': results
+    }
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2)
+    print("Results written to " + args.output)
+
+
+if __name__ == '__main__':
+    main()
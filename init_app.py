@@ -1,5 +1,7 @@
+import click
 from flask import Flask
 from populate_db import populate
+from populate_synthetic import populate_synthetic
 from routes.reviews import reviews_bp
 from routes.users import users_bp
 from routes.services import services_bp
@@ -9,17 +11,24 @@ from routes.contracted_services import contracted_services_bp
 from routes.chat_rooms import chat_rooms_bp
 from routes.chat_messages import chat_message_bp
 from routes.hashtags import hashtags_bp
+from routes.images import images_bp
 from database import db
 from flask_migrate import Migrate
 from flask_cors import CORS
 from database import secret_key
+from models.search import term_frequency
+from models.service import Service
+from models.user import User
+from utils.image_store import migrate_images
+from utils.reindex import reindex, compact
+from utils.search_cache import search_cache
 
 
 def init_app(database_location, develop=True):
 
     # creamos la app
     app = Flask(__name__)
-    CORS(app)
+    CORS(app, expose_headers=['X-Next-Cursor'])
     app.config["SQLALCHEMY_DATABASE_URI"] = database_location
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     app.config['SECRET_KEY'] = secret_key
@@ -29,6 +38,15 @@ def init_app(database_location, develop=True):
     app.config['MAIL_PASSWORD'] = 'huotojlsvpgnlfaz'
     app.config['MAIL_USE_TLS'] = False
     app.config['MAIL_USE_SSL'] = True
+    app.config['SEARCH_CACHE_BYTES'] = 16 * 1024 * 1024
+    app.config['SEARCH_ENGINE'] = 'python'  # 'sparse' puntúa con matrices dispersas (requiere scipy)
+    app.config['SEARCH_SHARDS'] = 0  # > 1 puntúa el índice repartido en ese número de procesos (requiere numpy)
+    app.config['SEARCH_BACKEND'] = 'term_frequency'  # 'fts5' busca con una tabla FTS5 de SQLite
+    app.config['SEARCH_INDEX_ASYNC'] = False  # True indexa los servicios en un hilo aparte
+    app.config['SEARCH_INDEX_WAIT'] = False  # True espera a que se indexe el servicio (para los tests)
+    app.config['IMAGE_STORE'] = 'local'
+    app.config['IMAGE_STORE_PATH'] = None  # None guarda las imágenes en instance/images
+    search_cache.resize(app.config['SEARCH_CACHE_BYTES'])
     if develop:
 
         Migrate(app, db)
@@ -39,6 +57,9 @@ def init_app(database_location, develop=True):
         with app.app_context():
             populate(db)
 
+            # cargamos el índice de búsqueda en memoria
+            term_frequency.load_index()
+
     else:
 
         # TODO meter aquí la configuración de la BD de producción
@@ -54,9 +75,49 @@ def init_app(database_location, develop=True):
     app.register_blueprint(chat_rooms_bp)
     app.register_blueprint(chat_message_bp)
     app.register_blueprint(hashtags_bp)
+    app.register_blueprint(images_bp)
 
     @app.route('/')
     def hello_world():  # put application's code here
         return 'Hello World!'
 
+    @app.cli.command('reindex')
+    @click.option('--batch-size', default=1000, show_default=True, help='Services inserted at once.')
+    @click.option('--workers', default=0, show_default=True, help='Processes used to tokenize (0: no pool).')
+    def reindex_command(batch_size, workers):
+        """Rebuilds the search index tables from all the services."""
+        reindex(batch_size=batch_size, workers=workers, echo=click.echo)
+
+    @app.cli.command('populate-synthetic')
+    @click.option('--users', default=10000, show_default=True, help='Number of synthetic users.')
+    @click.option('--seed', default=0, show_default=True, help='Seed of the random generator.')
+    @click.option('--batch-size', default=5000, show_default=True, help='Users inserted at once.')
+    def populate_synthetic_command(users, seed, batch_size):
+        """Fills the database with a synthetic catalog and rebuilds the search index."""
+        populate_synthetic(db, n_users=users, seed=seed, batch_size=batch_size, echo=click.echo)
+        reindex(batch_size=5000, echo=click.echo)
+
+    @app.cli.command('backfill-popularity')
+    def backfill_popularity_command():
+        """Adds the completed contracts counter to older databases and recomputes it for every master service."""
+        if Service.upgrade_table():
+            click.echo("Added the completed_contracts column to the services table")
+        n = Service.count_completed_contracts()
+        click.echo(f"{n} services with completed contracts")
+
+    @app.cli.command('migrate-images')
+    @click.option('--batch-size', default=100, show_default=True, help='Rows updated at once.')
+    def migrate_images_command(batch_size):
+        """Moves the images kept as data URLs in the database to the image store."""
+        n = migrate_images(Service, Service.id, [getattr(Service, 'image' + str(i)) for i in range(1, 6)],
+                           batch_size, click.echo)
+        n += migrate_images(User, User.email, [User.image], batch_size, click.echo)
+        search_cache.bump_version()
+        click.echo(f"Moved {n} images")
+
+    @app.cli.command('compact-index')
+    def compact_index_command():
+        """Deletes the search index rows of deleted and replaced services."""
+        compact(echo=click.echo)
+
     return app, db
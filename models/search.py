@@ -1,9 +1,28 @@
-from sqlalchemy import and_
+from collections import defaultdict
+from functools import partial
+
+from flask import current_app
+from sqlalchemy import event, func
 
-from sqlalchemy.sql import alias
 from database import db
-from sklearn.feature_extraction.text import CountVectorizer
-token_pattern = r'(?u)[\#]?\b\w\w+\b'
+from utils.index_queue import index_queue
+from utils.search_cache import search_cache
+from utils.search_index import search_index
+from utils.sharded_search import sharded_engine
+from utils.sparse_search import sparse_engine
+from utils.tokenizer import tokenize, tokenize_search
+
+
+class DocumentStats(db.Model):
+    """
+    Per service statistics used by the ranking, so that scoring doesn't need to load the services
+    """
+    __tablename__ = 'document_stats'
+
+    service_id = db.Column(db.Integer, db.ForeignKey('services.id'), primary_key=True)
+    length = db.Column(db.Integer, nullable=False)  # len(title) + len(description)
+    n_terms = db.Column(db.Integer, nullable=False)  # número de tokens del servicio
+    state = db.Column(db.Integer, nullable=False)  # estado del servicio
 
 
 class term_frequency(db.Model):
@@ -16,52 +35,168 @@ class term_frequency(db.Model):
 
     @classmethod
     def tokenize(cls, s: str):
-        cv = CountVectorizer(token_pattern=token_pattern)
-        cv_matrix = cv.fit_transform([s.lower()])
-        return zip(cv.get_feature_names(), cv_matrix.toarray()[0])
+        return tokenize(s)
 
     @classmethod
     def put_service(cls, s):
+        """
+        Updates the index of a service. With SEARCH_INDEX_ASYNC the service is indexed by the worker of the index
+        queue after the request, and with SEARCH_INDEX_WAIT this method waits for it (p.e. in the tests)
+        :param s: the service
+        """
+        if not current_app.config.get('SEARCH_INDEX_ASYNC'):
+            cls.index_service(s)
+            return
+
+        index_queue.put(s.id, partial(cls._index_async, current_app._get_current_object(), s.id))
+        if current_app.config.get('SEARCH_INDEX_WAIT'):
+            cls.wait_for_index()
+
+    @classmethod
+    def wait_for_index(cls, timeout=None):
+        """
+        Waits until the services pending in the index queue are indexed
+        :param timeout: max seconds to wait, None waits forever
+        :return: True if all the services are indexed
+        """
+        return index_queue.wait(timeout)
+
+    @classmethod
+    def _index_async(cls, app, service_id):
+        from models.service import Service  # Import aquí para evitar el import circular
+
+        with app.app_context():
+            s = Service.get_by_id(service_id)
+            if s is not None:
+                cls.index_service(s)
+            # Las búsquedas hechas antes de indexar pueden haber guardado resultados antiguos
+            search_cache.bump_version()
+
+    @classmethod
+    def index_service(cls, s):
+        """
+        Replaces the term_frequency rows and the statistics of a service and updates the in-memory index. Only
+        live services (state 0 or 1) are indexed, deleted or replaced versions are removed from the index
+        :param s: the service
+        """
         db.session.query(cls).filter(cls.service_id == s.id).delete()
         # db.session.commit()
 
-        for word, count in cls.tokenize(s.title + ' ' + s.description):
+        if s.state == 2:
+            db.session.query(DocumentStats).filter(DocumentStats.service_id == s.id).delete()
+            db.session.commit()
+            search_index.remove(s.id)
+            return
+
+        counts = cls.tokenize(s.title + ' ' + s.description)
+        for word, count in counts:
             coincidence = cls(word=word, count=count)
             coincidence.service = s
             db.session.add(coincidence)
 
+        length = len(s.description) + len(s.title)
+        db.session.merge(DocumentStats(service_id=s.id, length=length, n_terms=sum(c for _, c in counts), state=s.state))
+
         db.session.commit()
+        search_index.put(s.id, counts, length, s.state)
 
     @classmethod
-    def get_coincidences(cls, word):
-        search_term_regex = f'%{word}%'
-        return cls.query.filter(term_frequency.word.like(search_term_regex))
+    def load_index(cls):
+        """
+        Builds the in-memory search index from the term_frequency and document_stats tables, skipping the
+        rows of services that are no longer live
+        """
+        from models.service import Service  # Import aquí para evitar el import circular
+
+        n_terms = defaultdict(int)
+
+        def postings():
+            rows = db.session.query(cls.word, cls.service_id, cls.count).join(Service, Service.id == cls.service_id) \
+                .filter(Service.state != 2).order_by(cls.service_id)
+            for word, service_id, count in rows:
+                count = count_to_int(count)
+                n_terms[service_id] += count
+                yield word, service_id, count
+
+        def documents():
+            yield from db.session.query(DocumentStats.service_id, DocumentStats.length, DocumentStats.n_terms,
+                                        DocumentStats.state).filter(DocumentStats.state != 2)
+
+            # Servicios indexados antes de que existiera document_stats
+            missing = db.session.query(Service.id, func.length(Service.description) + func.length(Service.title),
+                                       Service.state).filter(Service.id.notin_(db.session.query(DocumentStats.service_id)),
+                                                             Service.state != 2)
+            for service_id, length, state in missing:
+                yield service_id, length, n_terms[service_id], state
+
+        search_index.build(postings(), documents())
 
     @classmethod
-    def get_matches_all_words(cls, words):
-
-        q = cls.query
+    def compact(cls):
+        """
+        Deletes the term_frequency and document_stats rows of services that are deleted, replaced by a newer
+        version or don't exist, left by older versions that indexed every service
+        :return: (number of term_frequency rows deleted, number of document_stats rows deleted)
+        """
+        from models.service import Service  # Import aquí para evitar el import circular
+
+        live = db.session.query(Service.id).filter(Service.state != 2)
+        n_rows = db.session.query(cls).filter(cls.service_id.notin_(live)).delete(synchronize_session=False)
+        n_stats = db.session.query(DocumentStats).filter(DocumentStats.service_id.notin_(live)) \
+            .delete(synchronize_session=False)
+        db.session.commit()
+        return n_rows, n_stats
 
-        for word in words:
-            b = alias(cls)
-            q = q.join(b, and_(b.c.service_id == cls.service_id, cls.word == word))
+    @classmethod
+    def get_index(cls):
+        """
+        Returns the in-memory search index, loading it if necessary
+        :return: the search index
+        """
+        if not search_index.loaded:
+            cls.load_index()
+        return search_index
 
-        return q
+    @classmethod
+    def get_coincidences(cls, word):
+        # El índice de n-gramas da las palabras que contienen word, así se consulta por palabra exacta
+        return cls.query.filter(term_frequency.word.in_(cls.get_index().matching_words(word)))
 
+    @classmethod
+    def get_matches_all_words(cls, words):
+        """
+        Returns the services that contain all the given words (p.e. hashtags)
+        :param words: list of words
+        :return: sorted list of service ids
+        """
+        return cls.get_index().match_all(words)
 
     @classmethod
     def search_text(cls, s: str):
-        cv = CountVectorizer(token_pattern=token_pattern)
-        try:
-            cv.fit_transform([s.lower()])
-            tokens = cv.get_feature_names()
-            words = [t for t in tokens if t[0] != '#']
-            hashtags = [t for t in tokens if t[0] == '#']
-        except ValueError:
-            words = hashtags = []
-
-        return [(word, cls.get_coincidences(word)) for word in words], cls.get_matches_all_words(hashtags)
-
+        """
+        :param s: search text
+        :return: the words and the hashtags of the text
+        """
+        return tokenize_search(s)
+
+
+def count_to_int(count):
+    """
+    Counts written by older versions were stored as little endian blobs
+    :param count: count read from the database
+    :return: the count as an int
+    """
+    if isinstance(count, bytes):
+        return int.from_bytes(count, "little")
+    return int(count)
+
+
+# Los motores disperso y por shards se mantienen al día con los cambios del índice
+search_index.add_listener(sparse_engine)
+search_index.add_listener(sharded_engine)
+
+# Si se borra la tabla (p.e. en los tests) el índice en memoria deja de ser válido
+event.listen(term_frequency.__table__, "after_drop", lambda *args, **kwargs: search_index.clear())
 
 
 
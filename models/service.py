@@ -1,12 +1,18 @@
+from sqlalchemy import event, func, inspect, select, text
 from sqlalchemy.orm import backref
+from sqlalchemy.sql import alias
 
 from database import db
 from models.contracted_service import ContractedService
 from models.search import term_frequency
+from utils.search_backends import get_search_backend
+from utils.search_cache import search_cache
 
 
 class Service(db.Model):
     __tablename__ = "services"
+    # Índice del feed de servicios nuevos: activos ordenados por fecha de creación e id
+    __table_args__ = (db.Index('ix_services_state_created_at_id', 'state', 'created_at', 'id'),)
 
     id = db.Column(db.Integer, primary_key=True)
     masterID = db.Column(db.Integer, db.ForeignKey('services.id'), nullable=True)
@@ -16,6 +22,8 @@ class Service(db.Model):
     price = db.Column(db.Numeric(scale=2), nullable=False, default=0)
     service_grade = db.Column(db.Float, default='NaN')
     number_of_reviews = db.Column(db.Integer, default = 0)
+    # Contratos completados de todas las versiones, solo se actualiza en el servicio maestro
+    completed_contracts = db.Column(db.Integer, nullable=False, default=0, index=True)
 
     contracts = db.relationship(ContractedService, backref="service", cascade="all, delete-orphan")
     created_at = db.Column(db.Date(), nullable=True)
@@ -53,9 +61,11 @@ class Service(db.Model):
         if self.masterID is None:
             self.masterID = self.id
             self.service_grade = 0.0
+            self.completed_contracts = 0
 
         db.session.commit()
-        term_frequency.put_service(self)
+        get_search_backend().put(self)
+        search_cache.bump_version()
 
     def delete_from_db(self):
         """
@@ -63,6 +73,8 @@ class Service(db.Model):
         """
         self.state = 2
         db.session.commit()
+        get_search_backend().put(self)
+        search_cache.bump_version()
 
     @classmethod
     def get_by_id(cls, instance_id):
@@ -81,6 +93,43 @@ class Service(db.Model):
         """
         return cls.query.all()
 
+    @classmethod
+    def count_completed_contracts(cls):
+        """
+        Recomputes the completed_contracts counter of every master service from the contracts of all its versions
+        with a single UPDATE. Used to fill the counter of existing databases or after changing contracts by hand
+        :return: number of services with completed contracts
+        """
+        brothers = alias(cls)
+        counts = select(func.count(ContractedService.id)) \
+            .select_from(ContractedService.__table__.join(brothers, ContractedService.service_id == brothers.c.id)) \
+            .where(brothers.c.masterID == cls.id, ContractedService.state == 2).scalar_subquery()
+        db.session.query(cls).update({cls.completed_contracts: counts}, synchronize_session=False)
+        db.session.commit()
+        search_cache.bump_version()
+        return cls.query.filter(cls.completed_contracts > 0).count()
+
+    @classmethod
+    def upgrade_table(cls):
+        """
+        Adds to a services table created by an older version the completed_contracts column and the indexes that it
+        lacks, as db.create_all doesn't change existing tables
+        :return: True if the column has been added
+        """
+        columns = {c['name'] for c in inspect(db.engine).get_columns(cls.__tablename__)}
+        added = 'completed_contracts' not in columns
+        if added:
+            db.session.execute(text(f"ALTER TABLE {cls.__tablename__} "
+                                    f"ADD COLUMN completed_contracts INTEGER NOT NULL DEFAULT 0"))
+            db.session.commit()
+        for index in cls.__table__.indexes:
+            index.create(db.engine, checkfirst=True)
+        return added
+
     @classmethod
     def get_count(cls):
         return cls.query.filter_by(state=0).count()
+
+
+# Si se borra la tabla (p.e. en los tests) las búsquedas cacheadas dejan de ser válidas
+event.listen(Service.__table__, "after_drop", lambda *args, **kwargs: search_cache.bump_version())
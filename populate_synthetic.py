@@ -0,0 +1,169 @@
+import random
+from datetime import date, datetime, timedelta
+from itertools import accumulate
+
+from sqlalchemy import bindparam, func
+
+from models.chat_message import ChatMessage
+from models.chat_room import ChatRoom
+from models.contracted_service import ContractedService
+from models.review import Review
+from models.service import Service
+from models.user import User
+
+# Palabras frecuentes de los servicios, el resto del vocabulario se genera con sílabas
+common_words = ['clases', 'classes', 'english', 'inglés', 'guitar', 'guitarra', 'piano', 'cleaning', 'limpieza',
+                'cooking', 'cocina', 'cheese', 'bread', 'programming', 'programmer', 'python', 'web', 'design',
+                'diseño', 'photography', 'fotografía', 'garden', 'jardín', 'painting', 'pintura', 'repair',
+                'reparación', 'plumber', 'electrician', 'moving', 'mudanza', 'dog', 'perro', 'walking', 'paseo',
+                'math', 'matemáticas', 'physics', 'física', 'yoga', 'fitness', 'personal', 'trainer', 'massage',
+                'hair', 'makeup', 'wedding', 'boda', 'party', 'fiesta', 'music', 'música', 'translation',
+                'traducción', 'computer', 'ordenador', 'phone', 'bike', 'bici', 'car', 'coche', 'home', 'casa',
+                'online', 'weekend', 'barcelona', 'madrid', 'experience', 'experiencia', 'professional', 'cheap',
+                'fast', 'quality', 'calidad', 'help', 'ayuda', 'students', 'kids', 'niños', 'adults', 'beginners']
+syllables = ['ba', 'be', 'ca', 'co', 'da', 'de', 'fa', 'ga', 'la', 'le', 'lo', 'ma', 'me', 'mi', 'na', 'no', 'pa',
+             'pe', 'ra', 're', 'ri', 'sa', 'se', 'ta', 'te', 'to', 'va', 'za', 'ción', 'dor', 'mente', 'ista']
+
+
+def zipf_weights(n, s):
+    """
+    :param n: number of items
+    :param s: exponent of the distribution
+    :return: cumulative weights of a Zipf distribution over n items, for random.choices
+    """
+    return list(accumulate(1 / rank ** s for rank in range(1, n + 1)))
+
+
+def build_vocabulary(rng, n_words, n_hashtags):
+    """
+    :param rng: random generator
+    :param n_words: size of the vocabulary
+    :param n_hashtags: number of different hashtags
+    :return: (words, hashtags), most frequent first
+    """
+    words = list(common_words)
+    seen = set(words)
+    while len(words) < n_words:
+        word = ''.join(rng.choice(syllables) for _ in range(rng.randint(2, 4)))
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+
+    # Los hashtags más usados son las palabras frecuentes, el resto se escoge entre las siguientes
+    hashtags = ['#' + word for word in common_words[:n_hashtags]]
+    hashtags += ['#' + word for word in rng.sample(words[len(hashtags):n_hashtags * 2], n_hashtags - len(hashtags))]
+    return words, hashtags
+
+
+def populate_synthetic(db, n_users=10000, services_per_user=2.0, contracts_per_service=1.5, messages_per_chat=4,
+                       n_words=5000, n_hashtags=300, seed=0, batch_size=5000, echo=print):
+    """
+    Fills the database with a reproducible synthetic catalog using bulk inserts: users, services whose words and
+    hashtags follow Zipf distributions, contracts, reviews (with the grades of services and users) and chat rooms
+    with messages. The search index tables are not filled, run reindex afterwards.
+    :param db: the database
+    :param n_users: number of users
+    :param services_per_user: average number of services of a user (exponential distribution)
+    :param contracts_per_service: average number of contracts of a service (exponential distribution)
+    :param messages_per_chat: average number of messages of a chat room
+    :param n_words: size of the vocabulary of the descriptions
+    :param n_hashtags: number of different hashtags
+    :param seed: seed of the random generator, the same seed gives the same data
+    :param batch_size: number of users generated and inserted at once
+    :param echo: function used to report the progress
+    :return: dict with the number of rows inserted in every table
+    """
+    rng = random.Random(seed)
+    db.create_all()
+
+    words, hashtags = build_vocabulary(rng, n_words, n_hashtags)
+    word_weights = zipf_weights(len(words), 1.1)
+    hashtag_weights = zipf_weights(len(hashtags), 1.2)
+
+    pwd = User.hash_password("password")  # el hash es lento, todos los usuarios comparten contraseña
+    first_user = db.session.query(func.count(User.email)).scalar()
+    emails = ["synthetic" + str(first_user + i) + "@gmail.com" for i in range(n_users)]
+    today = date.today()
+
+    next_service = (db.session.query(func.max(Service.id)).scalar() or 0) + 1
+    next_contract = (db.session.query(func.max(ContractedService.id)).scalar() or 0) + 1
+    counts = {'users': 0, 'services': 0, 'contracts': 0, 'reviews': 0, 'chat_rooms': 0, 'chat_messages': 0}
+    user_grades = {}  # email -> (suma de estrellas, número de reviews)
+
+    for start in range(0, n_users, batch_size):
+        batch_emails = emails[start:start + batch_size]
+        users = [{'email': email, 'pwd': pwd, 'name': 'Synthetic ' + email.split('@')[0], 'access': 1,
+                  'verified_email': True, 'wallet': rng.randint(0, 1000), 'state': 0} for email in batch_emails]
+
+        services, contracts, reviews, rooms, messages = [], [], [], [], []
+        reviewed = set()
+        for email in batch_emails:
+            for _ in range(min(int(rng.expovariate(1 / services_per_user)), 50)):
+                service_id = next_service
+                next_service += 1
+
+                title = rng.choices(words, cum_weights=word_weights, k=rng.randint(2, 6))
+                description = rng.choices(words, cum_weights=word_weights, k=max(3, int(rng.lognormvariate(3, 0.6))))
+                description += rng.choices(hashtags, cum_weights=hashtag_weights, k=rng.choice([0, 0, 1, 1, 2, 3]))
+                rng.shuffle(description)
+                price = round(rng.lognormvariate(3, 1), 2)
+
+                stars = []
+                completed = 0
+                for _ in range(int(rng.expovariate(1 / contracts_per_service))):
+                    client = rng.choice(emails)
+                    if client == email:
+                        continue
+                    state = rng.choices([0, 1, 2, 3], weights=[2, 3, 4, 1])[0]
+                    contracts.append({'id': next_contract, 'user_email': client, 'service_id': service_id,
+                                      'state': state, 'validate_c': state == 2, 'validate_s': state == 2})
+
+                    completed += state == 2
+                    if state >= 1:
+                        sent = datetime(today.year, today.month, today.day) - timedelta(minutes=rng.randint(0, 10 ** 6))
+                        rooms.append({'id': next_contract, 'update': sent, 'state': 0})
+                        for m in range(int(rng.expovariate(1 / messages_per_chat))):
+                            messages.append({'room_id': next_contract, 'user_email': (client, email)[m % 2],
+                                             'text': ' '.join(rng.choices(words, cum_weights=word_weights, k=8)),
+                                             'time': sent + timedelta(minutes=m), 'state': 0})
+
+                    # Los contratos completados (estado 2) pueden tener una review por cliente
+                    if state == 2 and rng.random() < 0.5 and (client, service_id) not in reviewed:
+                        reviewed.add((client, service_id))
+                        stars.append(rng.choices([1, 2, 3, 4, 5], weights=[1, 1, 2, 4, 5])[0])
+                        reviews.append({'reviewer_email': client, 'service_id': service_id, 'title': 'Review',
+                                        'text': ' '.join(rng.choices(words, cum_weights=word_weights, k=12)),
+                                        'stars': stars[-1]})
+                    next_contract += 1
+
+                if stars:
+                    total, n = user_grades.get(email, (0, 0))
+                    user_grades[email] = (total + sum(stars), n + len(stars))
+
+                services.append({'id': service_id, 'masterID': service_id, 'user_email': email,
+                                 'title': ' '.join(title).capitalize(), 'description': ' '.join(description),
+                                 'price': price, 'service_grade': sum(stars) / len(stars) if stars else 0.0,
+                                 'number_of_reviews': len(stars), 'completed_contracts': completed,
+                                 'requiresPlace': rng.random() < 0.3,
+                                 'created_at': today - timedelta(days=rng.randint(0, 3 * 365)),
+                                 'state': rng.choices([0, 1, 2], weights=[90, 5, 5])[0]})
+
+        for model, rows in ((User, users), (Service, services), (ContractedService, contracts), (Review, reviews),
+                            (ChatRoom, rooms), (ChatMessage, messages)):
+            if rows:
+                db.session.execute(model.__table__.insert(), rows)
+        db.session.commit()
+
+        for name, rows in (('users', users), ('services', services), ('contracts', contracts), ('reviews', reviews),
+                           ('chat_rooms', rooms), ('chat_messages', messages)):
+            counts[name] += len(rows)
+        echo(f"{counts['users']}/{n_users} users, {counts['services']} services, {counts['contracts']} contracts")
+
+    if user_grades:
+        update = User.__table__.update().where(User.__table__.c.email == bindparam('b_email')) \
+            .values(user_grade=bindparam('b_grade'), number_of_reviews=bindparam('b_reviews'))
+        db.session.execute(update, [{'b_email': email, 'b_grade': total / n, 'b_reviews': n}
+                                    for email, (total, n) in user_grades.items()])
+        db.session.commit()
+
+    return counts
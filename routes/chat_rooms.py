@@ -1,5 +1,5 @@
 from flask import Blueprint, jsonify, request
-from marshmallow import validates
+from marshmallow import validates, post_dump
 from marshmallow_sqlalchemy import SQLAlchemyAutoSchema, auto_field
 from sqlalchemy import or_, desc
 from werkzeug.exceptions import NotFound, Conflict
@@ -11,6 +11,7 @@ from models.user import auth
 from flask import g
 
 from utils.custom_exceptions import PrivilegeException
+from utils.image_store import image_urls
 from utils.privilegies import access
 from database import db
 from marshmallow_sqlalchemy.fields import Nested
@@ -27,6 +28,13 @@ class ServiceSchema(SQLAlchemyAutoSchema):
 
     user = auto_field()
 
+    @post_dump
+    def dump_images(self, data, **kwargs):
+        """
+        Replaces the hashes of the stored images by the url where they are served
+        """
+        return image_urls(data, ('image1', 'image2', 'image3', 'image4', 'image5'))
+
 
 class ContractedServiceSchema(SQLAlchemyAutoSchema):
     class Meta:
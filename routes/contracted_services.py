@@ -237,6 +237,9 @@ def validate_contract(contract_id):
         raise PrivilegeException("Not enough privileges to modify other resources.")
     if contract.validate_s and contract.validate_c:
         contract.state = 2
+        # La popularidad se cuenta en el servicio maestro, el incremento se hace en SQL
+        master = Service.get_by_id(service.masterID)
+        master.completed_contracts = Service.completed_contracts + 1
         user_seller.wallet += service.price
         user_seller.save_to_db()
         transaction = Transaction(user_email=user_seller.email,
@@ -288,37 +291,47 @@ def check(contract_id):
 
     # No service
     if not service:
-        contract.state = 3
-        contract.save_to_db()
+        cancel_contract(contract, service)
         raise NotFound("Service not found. Contract cancelled.")
 
     user_seller = User.get_by_id(service.user_email)
     user_client = User.get_by_id(contract.user_email)
 
     if not user_client and not user_seller:
-        contract.state = 3
-        contract.save_to_db()
+        cancel_contract(contract, service)
         raise NotFound("Both users of the contract have been deleted. Contract cancelled.")
 
     if not user_seller:
         user_client.wallet += service.price
         user_client.save_to_db()
-        contract.state = 3
-        contract.save_to_db()
+        cancel_contract(contract, service)
         return_cancelled_service(contract.service.title, contract.service.price, user_client)
         raise NotFound("Seller has been deleted. Contract cancelled.")
 
     if not user_client:
         user_seller.wallet += service.price
         user_seller.save_to_db()
-        contract.state = 3
-        contract.save_to_db()
+        cancel_contract(contract, service)
         return_cancelled_service(contract.service.title, contract.service.price, user_seller)
         raise NotFound("Client has been deleted. Contract cancelled.")
 
     return contract, service, user_client, user_seller
 
 
+def cancel_contract(contract, service):
+    """
+    Support method used to cancel a contract. If it was completed it stops counting in the popularity of the service
+    :param contract: the contract that is going to be cancelled
+    :param service: the service of the contract, None if it doesn't exist
+    """
+    if contract.state == 2 and service is not None:
+        master = Service.get_by_id(service.masterID)
+        if master is not None:
+            master.completed_contracts = Service.completed_contracts - 1
+    contract.state = 3
+    contract.save_to_db()
+
+
 def return_cancelled_service(name, price, user_client):
     transaction = Transaction(user_email=user_client.email, description="Service cancelled: " + name,
                               number=user_client.number_transactions, quantity=price, wallet=user_client.wallet)
@@ -0,0 +1,32 @@
+from flask import Blueprint
+from werkzeug.exceptions import NotFound
+
+from models.user import auth
+from utils.image_store import get_image_store
+from utils.privilegies import access
+
+# Todas las url de imágenes empiezan por esto
+images_bp = Blueprint("images", __name__, url_prefix="/images")
+
+# Una imagen nunca cambia de contenido (la url es su hash), se puede cachear un año
+image_max_age = 365 * 24 * 3600
+
+
+@images_bp.route("/<string:image_hash>", methods=["GET"])
+@auth.login_required(role=[access[0], access[1], access[8], access[9]])
+def get_image(image_hash):
+    """
+    This method returns a stored image. It doesn't require privileges. The response can be cached forever and
+    answers conditional (If-None-Match) and range requests
+    :param image_hash: sha256 of the image
+    :return: Response with the bytes of the image
+    """
+    store = get_image_store()
+    if not store.exists(image_hash):
+        raise NotFound("Image " + image_hash + " not found!")
+
+    response = store.send(image_hash, image_max_age)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    return response
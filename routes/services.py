@@ -1,21 +1,36 @@
 import json
-from flask import Blueprint, jsonify, request
-from marshmallow import validates, ValidationError
+from functools import lru_cache, partial
+from itertools import islice
+
+from flask import Blueprint, jsonify, request, Response, current_app, stream_with_context
+from marshmallow import validates, ValidationError, pre_load, post_dump
 from marshmallow_sqlalchemy import SQLAlchemyAutoSchema
-from werkzeug.exceptions import NotFound
+from werkzeug.exceptions import NotFound, BadRequest
 from database import db
+from sqlalchemy.orm import contains_eager, load_only, selectinload
 from sqlalchemy.orm.util import has_identity
+from models.search import term_frequency
 from models.service import Service
 from models.user import auth, User
 from routes.users import get_user
 from flask import g
 from utils.custom_exceptions import PrivilegeException
+from utils.image_store import store_image, store_images, image_urls
 from utils.privilegies import access
-from utils.search_utils import filter_query, sort_services, get_matches_text, sort_query_services, filter_email_state
+from utils.search_cache import search_cache
+from utils.search_explain import SearchExplain, no_explain
+from utils.search_facets import SearchFacets
+from utils.search_utils import filter_query, get_matches_text, sort_query_services, filter_email_state, get_page, \
+    paginate, visibility_class, get_matching_ids, sort_matches, load_services, iter_services, get_feed_page, \
+    feed_query
 
 # Todas las url de servicios empiezan por esto
 services_bp = Blueprint("services", __name__, url_prefix="/services")
 
+ndjson = 'application/x-ndjson'
+service_images = ('image1', 'image2', 'image3', 'image4', 'image5')
+stream_batch_size = 100  # servicios leídos y serializados a la vez en las respuestas en stream
+
 
 # Validación y serialización de servicios
 class ServiceSchema(SQLAlchemyAutoSchema):
@@ -44,23 +59,133 @@ class ServiceSchema(SQLAlchemyAutoSchema):
         if value < 0:
             raise ValidationError("Price can't be negative!")
 
+    @pre_load
+    def load_images(self, data, **kwargs):
+        """
+        Moves the images sent as data URLs to the image store, the service only keeps their hash
+        """
+        return store_images(data, service_images)
+
+    @post_dump
+    def dump_images(self, data, **kwargs):
+        """
+        Replaces the hashes of the stored images by the url where they are served
+        """
+        return image_urls(data, service_images)
+
 
 # Para crear servicio
 service_schema_all = ServiceSchema(exclude=['search_coincidences', 'contracts'])
 
+# Campos que se pueden pedir con fields: los del esquema, con los datos del vendedor en vez del usuario
+service_fields = frozenset(service_schema_all.fields) - {'user'} | {'user_name', 'user_email', 'user_grade'}
+dumped_relationships = ('master_service', 'child_services', 'reviews')
+
+
+def get_fields():
+    """
+    Reads the fields of the services asked by the request (sparse fieldset), in the json (a list or a comma
+    separated string) or in the query string (?fields=title,price)
+    :return: frozenset with the fields, always with the id, or None when all of them are wanted
+    """
+    if request.headers.get('content-type') == 'application/json':
+        fields = (request.get_json(silent=True) or {}).get('fields')
+    else:
+        fields = request.args.get('fields')
+    if fields is None:
+        return None
+
+    if isinstance(fields, str):
+        fields = fields.split(',')
+    if not isinstance(fields, list) or not all(isinstance(field, str) for field in fields):
+        raise BadRequest('fields must be a list of field names!')
+
+    fields = frozenset(field.strip() for field in fields if field.strip())
+    unknown = fields - service_fields
+    if unknown:
+        raise BadRequest('Unknown fields: ' + ', '.join(sorted(unknown)))
+    return fields | {'id'}
+
+
+@lru_cache(maxsize=128)
+def fieldset_schema(fields):
+    """
+    :param fields: frozenset of fields or None
+    :return: schema dumping only the fields (and the user, needed by add_seller)
+    """
+    if fields is None:
+        return service_schema_all
+    return ServiceSchema(only=(fields & frozenset(service_schema_all.fields)) | {'user'},
+                         exclude=['search_coincidences', 'contracts'])
+
+
+def load_options(fields):
+    """
+    :param fields: frozenset of fields or None
+    :return: loader options that read only the columns of the fields (and the keys of the relationships)
+    """
+    if fields is None:
+        return []
+    columns = [getattr(Service, field) for field in fields if field in Service.__mapper__.column_attrs]
+    return [load_only(*columns, Service.masterID, Service.user_email)]
+
+
+def select_fields(info, fields):
+    """
+    :param info: serialized service
+    :param fields: frozenset of fields or None
+    :return: the fields of info asked by the request
+    """
+    if fields is None:
+        return info
+    return {field: value for field, value in info.items() if field in fields}
+
 
 @services_bp.route("", methods=["GET"])
 @auth.login_required(role=[access[0], access[1], access[8], access[9]])
 def get_all_services():
-    all_services = Service.get_all()
-    return jsonify(service_schema_all.dump(all_services, many=True)), 200
+    """
+    This method returns all the services, serialized as get_service does. It doesn't require privileges. With
+    Accept: application/x-ndjson the services are streamed, one json per line, reading them from the database in
+    batches. ?fields=title,price returns only those fields (and the id)
+    :return: Response with all the services
+    """
+    fields = get_fields()
+    q = Service.query.options(*load_options(fields))
+    if wants_ndjson():
+        return stream_services(q.order_by(Service.id).yield_per(stream_batch_size),
+                               partial(serialize_services, fields=fields))
+
+    return jsonify(serialize_services(q.all(), fields=fields)), 200
+
+
+@services_bp.route("/feed", methods=["GET"])
+@auth.login_required(role=[access[0], access[1], access[8], access[9]])
+def get_feed():
+    """
+    This method returns the newest active services, sorted by creation date. It doesn't require privileges. The
+    page size is given with limit (20 by default, 100 at most) and the next page is requested with the cursor sent
+    in the X-Next-Cursor header. ?fields=title,price returns only those fields (and the id)
+    :return: Response with a page of services
+    """
+    fields = get_fields()
+    limit, after = get_feed_page(request.args)
+    q = Service.query.options(*load_options(fields)).filter(Service.state == 0)
+    page, next_cursor = feed_query(q, Service, limit, after)
+    return jsonify(serialize_services(page, fields=fields)), 200, page_headers(next_cursor)
 
 
 @services_bp.route("/search", methods=["GET", "POST"])
 @auth.login_required(role=[access[0], access[1], access[8], access[9]])
 def get_many_services(user_email=None):
     """
-    This method returns a list of services. It doesn't require privileges.
+    This method returns a list of services. It doesn't require privileges. Results can be paginated with limit
+    and cursor (in the json or in the query string), the cursor of the next page is sent in the X-Next-Cursor header.
+    Responses are cached until the catalog changes. With facets the response is {"services": [...], "facets": {...}}
+    with the counts of all the results by price, rating, hashtag and requiresPlace. With explain (admins only) the
+    response also has "explain", the time and rows of each stage of the search and the SQL executed. With
+    Accept: application/x-ndjson the services are streamed, one json per line, and the response is not cached.
+    With fields (a list in the json or ?fields=title,price) only those fields (and the id) are read and returned.
     :return: Response with all the services
     """
 
@@ -69,13 +194,142 @@ def get_many_services(user_email=None):
 
     q = filter_email_state(q, s1, user_email=user_email)
 
+    explain = get_explain()
+    facets = SearchFacets() if get_flag('facets') else None
+    fields = get_fields()
+    options = load_options(fields)
+    if wants_ndjson():
+        if explain.enabled or facets is not None:
+            raise BadRequest('facets and explain are not available with ' + ndjson)
+        # Los streams no se cachean, los servicios se leen y serializan por lotes
+        services, next_cursor = search_services(q, s1, stream=True, options=options)
+        return stream_services(services, partial(serialize_services, fields=fields), page_headers(next_cursor))
+
+    if explain.enabled:
+        with explain.capture_sql(db.engine):
+            page, next_cursor = search_services(q, s1, explain, facets, options=options)
+            services = serialize_services(page, explain, fields)
+        return jsonify(search_body(services, facets, explain)), 200, page_headers(next_cursor)
+
+    if request.headers.get('content-type') == 'application/json':
+        normalized_request = ('json', json.dumps(request.json, sort_keys=True))
+    else:
+        normalized_request = ('args', tuple(sorted(request.args.items(multi=True))))
+
+    key = search_cache.key(visibility_class(user_email), user_email, normalized_request)
+    cached = search_cache.get(key)
+    if cached is not None:
+        body, headers = cached
+        return Response(body, 200, headers, mimetype='application/json')
+
+    page, next_cursor = search_services(q, s1, facets=facets, options=options)
+
+    response = jsonify(search_body(serialize_services(page, fields=fields), facets))
+    search_cache.put(key, response.get_data(), page_headers(next_cursor))
+    return response, 200, page_headers(next_cursor)
+
+
+def search_body(services, facets=None, explain=no_explain):
+    """
+    :param services: serialized services
+    :param facets: SearchFacets of the search or None
+    :param explain: SearchExplain of the search
+    :return: the list of services, or a dict with the services, the facets and the explain when asked
+    """
+    if facets is None and not explain.enabled:
+        return services
+
+    body = {'services': services}
+    if facets is not None:
+        body['facets'] = facets.to_dict()
+    if explain.enabled:
+        body['explain'] = explain.to_dict()
+    return body
+
+
+@services_bp.route("/search/cache", methods=["GET"])
+@auth.login_required(role=[access[8], access[9]])
+def get_search_cache_stats():
+    """
+    This method returns the counters of the search cache. It requires admin privileges
+    :return: Response with hits, misses, entries, bytes, max_bytes and version
+    """
+    return search_cache.stats(), 200
+
+
+@services_bp.route("/suggest", methods=["GET"])
+@auth.login_required(role=[access[0], access[1], access[8], access[9]])
+def suggest_words():
+    """
+    This method completes a prefix with the words and hashtags that appear in more services. It doesn't
+    require privileges. Query string: prefix and n (number of suggestions, 10 by default, max 50)
+    :return: Response with the list of words
+    """
+    prefix = request.args.get('prefix', '').lower()
+    if len(prefix) == 0:
+        raise BadRequest('Specify a prefix!')
+
+    try:
+        n = min(int(request.args.get('n', 10)), 50)
+    except ValueError:
+        raise BadRequest('n must be an integer!')
+    if n <= 0:
+        raise BadRequest('n must be positive!')
+
+    return jsonify(term_frequency.get_index().suggest(prefix, n)), 200
+
+
+def get_flag(name):
+    """
+    Reads a boolean flag of the request, in the json (true) or in the query string (?name=true)
+    :param name: name of the flag
+    :return: True if the flag is set
+    """
+    if request.headers.get('content-type') == 'application/json':
+        return (request.get_json(silent=True) or {}).get(name, False) is True
+    return request.args.get(name, 'false').lower() == 'true'
+
+
+def get_explain():
+    """
+    Reads the explain flag of the request. Only admins can explain a search
+    :return: a SearchExplain if the search has to be explained, else no_explain
+    """
+    if not get_flag('explain'):
+        return no_explain
+
+    if g.user.access < 8:
+        raise PrivilegeException("Not enough privileges to explain searches.")
+
+    return SearchExplain()
+
+
+def search_services(q, s1, explain=no_explain, facets=None, stream=False, options=()):
+    """
+    Applies the search of the request to a query
+    :param q: query with the services that can be seen
+    :param s1: service table
+    :param explain: SearchExplain where the stages of the search are recorded
+    :param facets: SearchFacets where the counts of all the results are added, None if not needed
+    :param stream: if True and the results are not paginated, the services are returned as an iterator that
+    reads them from the database in batches
+    :param options: loader options of the queries of the services (see load_options)
+    :return: (list of services, cursor of the next page or None)
+    """
     if not request.headers.get('content-type') == 'application/json':
-        services = service_schema_all.dump(q, many=True)
-        for id_c, service in enumerate(services):
-            services[id_c] = json.loads(get_service(service["id"])[0].get_data().decode("utf-8"))
-        return jsonify(services), 200
+        limit, offset = get_page(request.args)
+        stream = stream and limit is None  # las páginas son pequeñas, solo se leen por lotes sin limit
+        if facets is not None:
+            collect_facets(q, s1, facets, explain)
+        with explain.stage('query') as stage:
+            window = page_query(q.options(*options).order_by(s1.id), limit, offset, stream)
+            if not stream:
+                stage['rows'] = len(window)
+        return paginate(window, limit, offset)
 
     info = request.json
+    limit, offset = get_page(info)
+    stream = stream and limit is None
 
     if 'filters' in info:
         filters = info['filters']
@@ -85,48 +339,172 @@ def get_many_services(user_email=None):
     q = filter_query(q, s1, filters=filters)
 
     if 'search_text' in info:
-        all_services = get_matches_text(q, s1, info['search_text'], search_order='sort' not in info, threshold=0.9)
         if 'sort' in info:
-            sort_services(all_services, info['sort'])
+            matched = get_matching_ids(q, s1, info['search_text'], search_order=False, threshold=0.9,
+                                       explain=explain, facets=facets)
+            # El criterio de orden de todos los resultados se lee con una consulta y se ordena en memoria
+            with explain.stage('sort', by=info['sort'].get('by')) as stage:
+                sorted_ids = sort_matches(s1, matched, info['sort'])
+                stage['rows'] = len(sorted_ids)
+            with explain.stage('load services') as stage:
+                window_ids = sorted_ids[offset:] if limit is None else sorted_ids[offset:offset + limit + 1]
+                if stream:
+                    window = iter_services(s1, window_ids, options=options)
+                else:
+                    window = load_services(s1, window_ids, options=options)
+                    stage['rows'] = len(window)
+        else:
+            window = get_matches_text(q, s1, info['search_text'], search_order=True,
+                                      ranking=info.get('ranking'), limit=limit, offset=offset,
+                                      explain=explain, facets=facets, stream=stream, options=options)
     else:
+        if facets is not None:
+            collect_facets(q, s1, facets, explain)
 
         if 'sort' in info:
             q = sort_query_services(q, s1, info['sort'])
-        all_services = q.all()
+        else:
+            q = q.order_by(s1.id)
+        with explain.stage('query') as stage:
+            window = page_query(q.options(*options), limit, offset, stream)
+            if not stream:
+                stage['rows'] = len(window)
+
+    return paginate(window, limit, offset)
+
+
+def collect_facets(q, s1, facets, explain=no_explain):
+    """
+    Adds all the services of a query to the facets
+    :param q: query with the filters of the search
+    :param s1: service table
+    :param facets: SearchFacets to update
+    :param explain: SearchExplain where the stage is recorded
+    """
+    with explain.stage('facets') as stage:
+        facets.collect_query(q, s1)
+        stage['rows'] = facets.total
 
-    services = service_schema_all.dump(all_services, many=True)
-    for id_c, service in enumerate(services):
-        services[id_c] = json.loads(get_service(service["id"])[0].get_data().decode("utf-8"))
-    return jsonify(services), 200
+
+def serialize_services(page, explain=no_explain, fields=None, chunk_size=500):
+    """
+    Serializes services as get_service does. The services are read again in chunks with one query that joins
+    their sellers and loads the versions and reviews they are related to, so the number of queries doesn't depend
+    on the number of services
+    :param page: list of services
+    :param explain: SearchExplain where the serialization is recorded
+    :param fields: frozenset with the fields to serialize (see get_fields) or None for all of them
+    :param chunk_size: max number of services per query
+    :return: list of serialized services
+    """
+    options = load_options(fields)
+    options += [selectinload(getattr(Service, relationship)) for relationship in dumped_relationships
+                if fields is None or relationship in fields]
+
+    with explain.stage('serialization') as stage:
+        ids = [s.id for s in page]
+        for i in range(0, len(ids), chunk_size):
+            # Las relaciones quedan cargadas en los objetos de la sesión, que son los mismos de page
+            Service.query.filter(Service.id.in_(ids[i:i + chunk_size])).outerjoin(Service.user) \
+                .options(contains_eager(Service.user), *options).all()
+
+        services = [select_fields(add_seller(info, service.user), fields) for info, service in
+                    zip(fieldset_schema(fields).dump(page, many=True), page)]
+        stage['rows'] = len(services)
+    return services
+
+
+def add_seller(info, user):
+    """
+    Replaces the user of a serialized service by the email, name and grade of the seller
+    :param info: serialized service
+    :param user: seller of the service
+    :return: info
+    """
+    info["user_name"] = user.name
+    info["user_email"] = info.pop("user")
+    info["user_grade"] = user.user_grade
+    return info
+
+
+def page_query(q, limit, offset, stream=False):
+    """
+    Returns the services of a query starting at offset. When paginated, one more service than the page size
+    is returned to know if there is a next page
+    :param q: query
+    :param limit: page size or None
+    :param offset: first position
+    :param stream: if True and not paginated, the query is returned to be iterated in batches
+    :return: list of services
+    """
+    if limit is not None:
+        return q.limit(limit + 1).offset(offset).all()
+    if stream:
+        return q.offset(offset).yield_per(stream_batch_size)
+    return q.offset(offset).all()
+
+
+def wants_ndjson():
+    """
+    :return: True if the client prefers a stream of services, one json per line, to a json list
+    """
+    return request.accept_mimetypes.best_match(['application/json', ndjson]) == ndjson
+
+
+def stream_services(services, serialize, headers=None):
+    """
+    Streams services as NDJSON. The services are serialized in batches while the response is sent, so the
+    memory used doesn't depend on the number of services
+    :param services: iterable of services
+    :param serialize: function serializing a list of services
+    :param headers: extra headers of the response
+    :return: streamed Response
+    """
+    services = iter(services)
+
+    def generate():
+        while True:
+            batch = list(islice(services, stream_batch_size))
+            if not batch:
+                break
+            yield ''.join(current_app.json.dumps(service) + '\n' for service in serialize(batch))
+
+    return Response(stream_with_context(generate()), 200, headers, mimetype=ndjson)
+
+
+def page_headers(next_cursor):
+    """
+    :param next_cursor: cursor of the next page or None
+    :return: headers of a paginated response
+    """
+    return {} if next_cursor is None else {'X-Next-Cursor': str(next_cursor)}
 
 
 @services_bp.route("/<int:service_id>", methods=["GET"])
 @auth.login_required(role=[access[0], access[1], access[8], access[9]])
 def get_service(service_id):
     """
-    This method returns a concrete service. It doesn't require privileges
+    This method returns a concrete service. It doesn't require privileges. ?fields=title,price returns only those
+    fields (and the id)
     :param service_id:
     :return: Response including the service
     """
-    service = Service.get_by_id(service_id)
+    fields = get_fields()
+    service = Service.query.options(*load_options(fields)).get(service_id)
     # En caso de no encontrar el servicio retornamos un mensaje de error.
     if not service:
         raise NotFound
-    info = service_schema_all.dump(service, many=False)
-    user = User.get_by_id(info["user"])
-    info["user_name"] = user.name
-    info["user_email"] = info["user"]
-    info["user_grade"] = user.user_grade
-    info.pop("user")
-    return jsonify(info), 200
+    info = fieldset_schema(fields).dump(service, many=False)
+    return jsonify(select_fields(add_seller(info, User.get_by_id(info["user"])), fields)), 200
 
 @services_bp.route("/<int:service_id>/image", methods=["POST"])
 @auth.login_required(role=[access[0], access[1], access[8], access[9]])
 def update_service_images(service_id):
     """
-    This method returns a concrete service. It doesn't require privileges
+    This method updates the images of a service. Images sent as data URLs are stored in the image store and served
+    by /images, the service only keeps their hash. It doesn't require privileges
     :param service_id:
-    :return: Response including the service
+    :return: Response
     """
     service = Service.get_by_id(service_id)
     # En caso de no encontrar el servicio retornamos un mensaje de error.
@@ -135,16 +513,17 @@ def update_service_images(service_id):
     
     d = request.json
 
+    # Las imágenes se guardan en el image store, en el servicio solo queda el hash
     if 'image1' in d:
-        service.image1 = d['image1']
+        service.image1 = store_image(d['image1'])
     if 'image2' in d:
-        service.image2 = d['image2']
+        service.image2 = store_image(d['image2'])
     if 'image3' in d:
-        service.image3 = d['image3']
+        service.image3 = store_image(d['image3'])
     if 'image4' in d:
-        service.image4 = d['image4']
+        service.image4 = store_image(d['image4'])
     if 'image5' in d:
-        service.image5 = d['image5']
+        service.image5 = store_image(d['image5'])
     
     service.save_to_db()
 
@@ -248,5 +627,6 @@ def interact_service(service_id):
         service.save_to_db()
         n_service = service_schema_all.load(info, session=db.session)  # De esta forma pasamos todos los constrains.
         n_service.masterID = service.masterID
+        n_service.completed_contracts = 0  # La popularidad se cuenta en el servicio maestro
         n_service.save_to_db()
         return {'modified_service_id': n_service.id}, 200
@@ -1,10 +1,11 @@
 from flask import Blueprint, jsonify, request
-from marshmallow import validates, ValidationError, validate
+from marshmallow import validates, ValidationError, validate, pre_load, post_dump
 from marshmallow_sqlalchemy import SQLAlchemyAutoSchema
 from werkzeug.exceptions import NotFound, Conflict, BadRequest
 from database import db
 from models.transactions import Transaction
 from utils.custom_exceptions import PrivilegeException, NotAcceptedPrivilege
+from utils.image_store import store_image, store_images, image_urls
 from utils.mail import send_email
 from models.user import User
 from models.user import auth
@@ -67,6 +68,20 @@ class UserSchema(SQLAlchemyAutoSchema):
         if value > 1:
             raise PrivilegeException("You cannot create a user with these privileges.")
 
+    @pre_load
+    def load_image(self, data, **kwargs):
+        """
+        Moves the image sent as a data URL to the image store, the user only keeps its hash
+        """
+        return store_images(data, ('image',))
+
+    @post_dump
+    def dump_image(self, data, **kwargs):
+        """
+        Replaces the hash of the stored image by the url where it is served
+        """
+        return image_urls(data, ('image',))
+
 
 # Para representar usuario sin exponer info sensible
 user_schema_repr = UserSchema(only=("name", "email", "birthday"))
@@ -305,7 +320,7 @@ def update_image(email):
     if not usr:
         raise NotFound("User not found")
 
-    usr.image = d['image']
+    usr.image = store_image(d['image'])  # en el usuario solo queda el hash de la imagen
 
     usr.save_to_db()
 
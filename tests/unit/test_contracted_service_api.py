@@ -2,6 +2,8 @@ import populate_db
 from init_app import init_app
 import pytest
 
+from models.contracted_service import ContractedService
+from models.user import User
 from utils.secure_request import request_with_login
 
 app, db = init_app("sqlite:///data_test.db")
@@ -194,13 +196,14 @@ def test_contract_correct(client):
     r = request_with_login(login=client.post, request=client.put, url=f"users/{email2}/wallet", json_r={'money': 5000},
                            email="madmin@gmail.com", pwd="password")
 
-    # Post a service
-    service1_dict = {'title': 'title', 'description': 'description', 'price': 1000}
+    # Post a service, the popularity can't be sent by the client
+    service1_dict = {'title': 'title', 'description': 'description', 'price': 1000, 'completed_contracts': 999}
     r = request_with_login(login=client.post, request=client.post, url="services", json_r=service1_dict, email=email1,
                            pwd=pwd1)
     assert r.status_code == 200
 
     service_id = r.get_json()['added_service_id']
+    assert client.get(f"services/{service_id}").get_json()['completed_contracts'] == 0
 
     # User2 contracts
     c_service1_dict = {'service': service_id}
@@ -282,6 +285,23 @@ def test_contract_correct(client):
     assert r.status_code == 200
     assert contract[0]["state"] == 2
 
+    # Check the completed contract counts for the popularity of the service
+    r = client.get(f"services/{service_id}")
+    assert r.get_json()['completed_contracts'] == 1
+    r = client.get("services/search", json={'filters': {'popularity': {'min': 1}}})
+    assert [s['id'] for s in r.get_json()] == [service_id]
+
+    # If the contract is cancelled because the client doesn't exist it stops counting
+    db.session.query(User).filter_by(email=email2).delete()
+    db.session.commit()
+    r = request_with_login(login=client.post, request=client.post, url=f"contracted_services/{contract_id}/validate",
+                           json_r={}, email=email1, pwd=pwd1)
+    assert r.status_code == 404
+    assert ContractedService.get_by_id(contract_id).state == 3
+    assert client.get(f"services/{service_id}").get_json()['completed_contracts'] == 0
+    r = client.get("services/search", json={'filters': {'popularity': {'min': 1}}})
+    assert r.get_json() == []
+
 
 def test_cancel_contract(client):
     # Credentials for contractor
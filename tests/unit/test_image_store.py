@@ -0,0 +1,131 @@
+import base64
+import hashlib
+import os
+
+import pytest
+
+from init_app import init_app
+from models.service import Service
+from models.user import User
+from utils.image_store import LocalImageStore, get_image_store, migrate_images, sniff_mimetype
+from utils.secure_request import request_with_login
+
+app, db = init_app("sqlite:///data_test.db")
+
+png = b'\x89PNG\r\n\x1a\n' + bytes(range(256)) * 4
+
+
+def data_url(data, mimetype='image/png'):
+    return 'data:' + mimetype + ';base64,' + base64.b64encode(data).decode()
+
+
+@pytest.fixture(scope='function', autouse=True)
+def client(tmp_path):
+    app.config['IMAGE_STORE_PATH'] = str(tmp_path)
+    with app.test_request_context():
+        db.drop_all()
+        db.create_all()
+        db.session.commit()
+        yield app.test_client()
+    app.config['IMAGE_STORE_PATH'] = None
+
+
+def test_local_image_store(tmp_path):
+    store = LocalImageStore(str(tmp_path))
+    image_hash = store.put(png)
+    assert image_hash == hashlib.sha256(png).hexdigest()
+    assert store.exists(image_hash)
+    assert not store.exists('0' * 64) and not store.exists('../' + image_hash)
+
+    # The same content is stored once
+    assert store.put(png) == image_hash
+    assert os.listdir(os.path.join(str(tmp_path), image_hash[:2])) == [image_hash]
+    assert os.stat(store.path(image_hash)).st_mode & 0o777 == 0o644
+
+    assert sniff_mimetype(png[:16]) == 'image/png'
+    assert sniff_mimetype(b'\xff\xd8\xff\xe0') == 'image/jpeg'
+    assert sniff_mimetype(b'RIFF\x00\x00\x00\x00WEBPVP8 ') == 'image/webp'
+    assert sniff_mimetype(b'<html>') == 'application/octet-stream'
+
+
+def test_service_images(client):
+    email1 = 'pepito@gmail.com'
+    pwd1 = '12345678'
+    r = client.post("users", json={'email': email1, 'pwd': pwd1, 'name': 'Pepito', 'access': 1,
+                                   'image': data_url(png)})
+    assert r.status_code == 201
+
+    service_dict = {'title': 'title', 'description': 'description', 'price': 10, 'image1': data_url(png)}
+    r = request_with_login(login=client.post, request=client.post, url="services", json_r=service_dict,
+                           email=email1, pwd=pwd1)
+    assert r.status_code == 200
+    service_id = r.get_json()['added_service_id']
+
+    r = client.post("services/" + str(service_id) + "/image",
+                    json={'image2': data_url(png, 'image/jpeg'), 'image3': 'https://example.com/cheese.jpg'})
+    assert r.status_code == 200
+
+    # The rows keep the hash, the same image is stored once
+    image_hash = hashlib.sha256(png).hexdigest()
+    service = Service.query.get(service_id)
+    assert service.image1 == service.image2 == User.query.get(email1).image == image_hash
+    assert service.image3 == 'https://example.com/cheese.jpg'
+
+    info = client.get("services/" + str(service_id)).get_json()
+    assert info['image1'] == info['image2'] == '/images/' + image_hash
+    assert info['image3'] == 'https://example.com/cheese.jpg'
+    assert info['image4'] is None
+    assert client.get("services").get_json()[0]['image1'] == '/images/' + image_hash
+
+    # The urls returned can be sent back
+    r = client.post("services/" + str(service_id) + "/image", json={'image4': info['image1'], 'image1': None})
+    assert r.status_code == 200
+    service = Service.query.get(service_id)
+    assert service.image4 == image_hash and service.image1 is None
+
+    r = client.post("services/" + str(service_id) + "/image", json={'image5': '/images/' + '0' * 64})
+    assert r.status_code == 400
+    r = client.post("services/" + str(service_id) + "/image", json={'image5': 'data:image/png;base64,???'})
+    assert r.status_code == 400
+
+
+def test_get_image(client):
+    image_hash = get_image_store().put(png)
+
+    r = client.get("images/" + image_hash)
+    assert r.status_code == 200
+    assert r.data == png
+    assert r.mimetype == 'image/png'
+    assert r.cache_control.max_age == 365 * 24 * 3600
+    assert r.cache_control.immutable
+    assert r.headers['X-Content-Type-Options'] == 'nosniff'
+
+    r = client.get("images/" + image_hash, headers={'If-None-Match': '"' + image_hash + '"'})
+    assert r.status_code == 304
+
+    r = client.get("images/" + image_hash, headers={'Range': 'bytes=8-15'})
+    assert r.status_code == 206
+    assert r.data == png[8:16]
+    assert r.headers['Content-Range'] == 'bytes 8-15/' + str(len(png))
+
+    assert client.get("images/" + '0' * 64).status_code == 404
+    assert client.get("images/..%2F..%2Fdata_test.db").status_code == 404
+
+
+def test_migrate_images(client):
+    user = User(email="emailT", pwd="passwordT", name="name", image=data_url(png))
+    user.save_to_db()
+    for image in (data_url(png), 'https://example.com/cheese.jpg', 'data:image/png;base64,???'):
+        s = Service(title="cheese", user=user, description="cheese", price=1, image1=image, image3=data_url(b'GIF89a'))
+        s.save_to_db()
+
+    messages = []
+    assert migrate_images(Service, Service.id, [Service.image1, Service.image3], 2, messages.append) == 4
+    assert migrate_images(User, User.email, [User.image], 2, messages.append) == 1
+
+    image_hash = hashlib.sha256(png).hexdigest()
+    assert User.query.get("emailT").image == image_hash
+    assert [s.image1 for s in Service.query.order_by(Service.id)] == \
+           [image_hash, 'https://example.com/cheese.jpg', 'data:image/png;base64,???']
+    assert {s.image3 for s in Service.query} == {hashlib.sha256(b'GIF89a').hexdigest()}
+    assert any('invalid image1' in message for message in messages)
@@ -0,0 +1,64 @@
+from sqlalchemy import func
+
+from benchmark_search import percentile
+from init_app import init_app
+from models.contracted_service import ContractedService
+from models.review import Review
+from models.service import Service
+from models.user import User
+from populate_synthetic import populate_synthetic
+from utils.reindex import reindex
+
+app, db = init_app("sqlite:///data_test.db")
+
+
+def snapshot():
+    return db.session.query(Service.id, Service.user_email, Service.title, Service.description, Service.price,
+                            Service.state, Service.service_grade).order_by(Service.id).all()
+
+
+def test_populate_synthetic():
+    with app.app_context():
+        db.drop_all()
+        counts = populate_synthetic(db, n_users=60, n_words=300, n_hashtags=20, seed=3, batch_size=25,
+                                    echo=lambda message: None)
+        assert counts['users'] == 60 == db.session.query(func.count(User.email)).scalar()
+        assert counts['services'] == db.session.query(func.count(Service.id)).scalar() > 0
+        assert counts['contracts'] == db.session.query(func.count(ContractedService.id)).scalar()
+        assert counts['reviews'] == db.session.query(func.count(Review.id)).scalar()
+        assert all(s.masterID == s.id for s in Service.query)
+
+        # Las notas de los servicios son la media de sus reviews
+        for service in Service.query.filter(Service.number_of_reviews > 0):
+            stars = [r.stars for r in Review.query.filter_by(service_id=service.id)]
+            assert service.service_grade == sum(stars) / len(stars)
+        first = snapshot()
+
+        # El contador de contratos completados coincide con el que se recalcula desde los contratos
+        completed = dict(db.session.query(Service.id, Service.completed_contracts))
+        Service.count_completed_contracts()
+        assert dict(db.session.query(Service.id, Service.completed_contracts)) == completed
+        assert sum(completed.values()) == ContractedService.query.filter_by(state=2).count()
+
+        # La misma semilla genera los mismos datos
+        db.drop_all()
+        populate_synthetic(db, n_users=60, n_words=300, n_hashtags=20, seed=3, batch_size=25, echo=lambda message: None)
+        assert snapshot() == first
+
+        n_services, _, _ = reindex(echo=lambda message: None)
+        assert n_services == Service.query.filter(Service.state != 2).count()
+
+        client = app.test_client()
+        r = client.get("services/search", json={'search_text': 'clases', 'limit': 5})
+        assert r.status_code == 200
+        assert 0 < len(r.get_json()) <= 5
+
+        db.drop_all()
+
+
+def test_percentile():
+    values = list(range(100, 0, -1))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile(values, 100) == 100
+    assert percentile([7], 99) == 7
@@ -0,0 +1,59 @@
+import pytest
+from werkzeug.exceptions import BadRequest
+
+from init_app import init_app
+from models.service import Service
+from models.user import User
+from utils.reindex import reindex
+from utils.search_utils import get_matches_text
+
+app, db = init_app("sqlite:///data_test.db")
+
+
+def test_fts5_backend():
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+        user_t = User(email="emailT", pwd="passwordT", name="name")
+        user_t.save_to_db()
+        cheese = Service(title="cheese maker", user=user_t, description="I make #cheese every day", price=10)
+        cheap = Service(title="cheap cheese", user=user_t, description="cheese cheese cheese #cheese #cheap", price=2)
+        bread = Service(title="bread", user=user_t, description="fresh bread", price=5)
+        for s in (cheese, cheap, bread):
+            s.save_to_db()
+
+        app.config['SEARCH_BACKEND'] = 'fts5'
+        try:
+            q = Service.query
+
+            # La tabla se llena con los servicios guardados antes de usar el backend
+            assert get_matches_text(q, Service, "cheese", search_order=True) == [cheap, cheese]
+            # Las palabras se buscan como prefijos
+            assert set(get_matches_text(q, Service, "chee bre", search_order=True)) == {cheese, cheap, bread}
+            assert get_matches_text(q, Service, "#cheap", search_order=True) == [cheap]
+            assert get_matches_text(q, Service, "#cheese maker", search_order=True) == [cheese]
+            assert get_matches_text(q.filter(Service.price > 5), Service, "cheese", search_order=True) == [cheese]
+            assert get_matches_text(q, Service, "wine", search_order=True) == []
+
+            # Los servicios guardados con el backend activo se actualizan en la tabla
+            bread.description = "fresh bread and cheese"
+            bread.save_to_db()
+            assert bread in get_matches_text(q, Service, "cheese", search_order=True)
+
+            # Solo puntúa con bm25, que es el ranking por defecto del backend
+            assert get_matches_text(q, Service, "cheese", search_order=True, ranking='bm25')[0] == cheap
+            with pytest.raises(BadRequest):
+                get_matches_text(q, Service, "cheese", search_order=True, ranking='tfidf')
+
+            # Los servicios guardados con otro backend se añaden a la tabla al reindexar
+            app.config['SEARCH_BACKEND'] = 'term_frequency'
+            wine = Service(title="wine seller", user=user_t, description="red wine", price=8)
+            wine.save_to_db()
+            app.config['SEARCH_BACKEND'] = 'fts5'
+            assert get_matches_text(q, Service, "wine", search_order=True) == []
+            reindex(echo=lambda message: None)
+            assert get_matches_text(q, Service, "wine", search_order=True) == [wine]
+        finally:
+            app.config['SEARCH_BACKEND'] = 'term_frequency'
+            db.drop_all()
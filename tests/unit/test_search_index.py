@@ -0,0 +1,422 @@
+import random
+import threading
+
+import pytest
+from sqlalchemy import event, func
+from werkzeug.exceptions import BadRequest
+
+from init_app import init_app
+from models.search import term_frequency, DocumentStats
+from models.service import Service
+from models.user import User
+from utils.index_queue import IndexQueue
+from utils.search_index import InvertedIndex, NgramIndex, PrefixTrie, DeletionIndex, intersect_sorted, edit_distance
+from models.contracted_service import ContractedService
+from utils.search_backends import get_candidates
+from utils.search_utils import get_matches_text, sort_matches
+
+app, db = init_app("sqlite:///data_test.db")
+
+
+def test_index_put_remove():
+    index = InvertedIndex()
+    index.put(2, [('cheese', 2), ('maker', 1)], 20, 0)
+    index.put(1, [('cheese', 1)], 10, 0)
+
+    assert list(index.postings['cheese'][0]) == [1, 2]
+    assert list(index.postings['cheese'][1]) == [1, 2]
+    assert index.documents[1].length == 10 and index.documents[2].length == 20
+    assert index.get_coincidences('che', {1, 2}) == [('cheese', 1, 1), ('cheese', 2, 2)]
+    assert index.get_coincidences('che', {2}) == [('cheese', 2, 2)]
+
+    # Reindexing a service replaces its postings
+    index.put(2, [('maker', 3)], 5, 1)
+    assert list(index.postings['cheese'][0]) == [1]
+    assert index.get_coincidences('make', {1, 2}) == [('maker', 2, 3)]
+
+    assert index.matching_services(['che', 'make']) == {1, 2}
+    assert index.indexed_services() == {1, 2}
+
+    index.remove(2)
+    assert 'maker' not in index.postings
+    assert 2 not in index.documents
+    assert index.matching_services(['che', 'make']) == {1}
+    assert index.indexed_services() == {1}
+
+
+def test_ngram_index():
+    vocabulary = NgramIndex()
+    for word in ['cheese', '#cheese', 'chess', 'program', 'programmer', 'ab', 'abba', 'abaxbab']:
+        vocabulary.add(word)
+
+    assert vocabulary.search('chee') == ['#cheese', 'cheese']
+    assert vocabulary.search('ches') == ['chess']
+    assert vocabulary.search('ab') == ['ab', 'abaxbab', 'abba']
+    assert vocabulary.search('bb') == ['abba']
+    assert vocabulary.search('gram') == ['program', 'programmer']
+    # All the trigrams are present but not contiguous
+    assert vocabulary.search('abab') == []
+    assert vocabulary.search('xyz') == []
+
+    vocabulary.remove('programmer')
+    assert vocabulary.search('gram') == ['program']
+    assert 'mme' not in vocabulary.grams
+
+    # Same answer as scanning the vocabulary
+    for substring in ['e', 'es', 'ese', 'hees', 'ogr', 'ba', '#c']:
+        assert vocabulary.search(substring) == sorted(w for w in vocabulary.words if substring in w)
+
+
+def test_intersect_sorted():
+    assert intersect_sorted([]) == []
+    assert intersect_sorted([[1, 4, 9]]) == [1, 4, 9]
+    assert intersect_sorted([list(range(0, 1000, 2)), list(range(0, 1000, 3)), [0, 6, 7, 600, 999]]) == [0, 6, 600]
+    assert intersect_sorted([[5, 10], list(range(100))]) == [5, 10]
+    assert intersect_sorted([[1, 2, 3], [4, 5, 6]]) == []
+
+    index = InvertedIndex()
+    index.put(1, [('#cheese', 1), ('#wine', 1)], 10, 0)
+    index.put(2, [('#cheese', 1)], 10, 0)
+    index.put(3, [('#cheese', 1), ('#wine', 2), ('#bread', 1)], 10, 0)
+    assert index.match_all(['#cheese', '#wine']) == [1, 3]
+    assert index.match_all(['#cheese', '#wine', '#bread']) == [3]
+    assert index.match_all(['#cheese', '#fish']) == []
+
+
+def test_prefix_trie():
+    trie = PrefixTrie()
+    for word in ['cheese', 'chess', 'che', '#cheese', 'bread']:
+        trie.add(word)
+
+    assert sorted(trie.complete('che')) == ['che', 'cheese', 'chess']
+    assert sorted(trie.complete('#')) == ['#cheese']
+    assert list(trie.complete('x')) == []
+
+    trie.remove('chess')
+    trie.remove('che')
+    trie.remove('unknown')
+    assert sorted(trie.complete('che')) == ['cheese']
+    assert 's' not in trie.root['c']['h']['e']
+
+    trie.remove('cheese')
+    assert 'c' not in trie.root
+
+    index = InvertedIndex()
+    index.put(1, [('cheese', 1), ('chess', 1)], 10, 0)
+    index.put(2, [('cheese', 2), ('#chef', 1)], 10, 0)
+    index.put(3, [('cheap', 1), ('cheese', 1), ('chess', 1)], 10, 0)
+    assert index.suggest('che', 2) == ['cheese', 'chess']
+    assert index.suggest('#', 5) == ['#chef']
+    index.remove(3)
+    assert index.suggest('che', 5) == ['cheese', 'chess']
+
+
+def test_suggest_cache():
+    rng = random.Random(0)
+    words = ['c' + ''.join(rng.choice('ab') for _ in range(rng.randint(0, 4))) for _ in range(60)]
+    index = InvertedIndex()
+    index.prefixes.top_size = 3
+
+    def expected(prefix, n):
+        matching = [w for w in index.postings if w.startswith(prefix)]
+        return sorted(matching, key=lambda w: (-len(index.postings[w][0]), w))[:n]
+
+    for service_id in range(200):
+        # Se indexan, reindexan y borran servicios, las listas guardadas tienen que seguir siendo exactas
+        if rng.random() < 0.2:
+            index.remove(rng.randrange(service_id + 1))
+        else:
+            counts = [(w, 1) for w in set(rng.sample(words, rng.randint(1, 5)))]
+            index.put(rng.randrange(service_id + 1), counts, 10, 0)
+        for prefix in ['c', 'ca', 'cb', 'cab', 'cbba']:
+            assert index.suggest(prefix, 3) == expected(prefix, 3)
+            assert index.suggest(prefix, 2) == expected(prefix, 2)
+        assert index.suggest('c', 10) == expected('c', 10)
+    assert index.prefixes.tops
+
+
+def test_typo_correction():
+    assert edit_distance('cheese', 'cheese', 2) == 0
+    assert edit_distance('chese', 'cheese', 2) == 1
+    assert edit_distance('cheeze', 'cheese', 2) == 1
+    assert edit_distance('hceese', 'cheese', 2) == 1
+    assert edit_distance('chsee', 'cheese', 2) == 2
+    assert edit_distance('bread', 'cheese', 2) == 3
+
+    typos = DeletionIndex()
+    for word in ['cheese', 'cheeses', 'chess', 'programmer', 'programmers']:
+        typos.add(word)
+    assert typos.lookup('chese', 2)[0] == 1
+    assert sorted(typos.lookup('chese', 2)[1]) == ['cheese', 'chess']
+    assert sorted(typos.lookup('cheesse', 2)[1]) == ['cheese', 'cheeses']
+    assert typos.lookup('programmeer', 2) == (1, ['programmer'])
+    assert sorted(typos.lookup('programerss', 2)[1]) == ['programmers']
+    assert typos.lookup('bread', 2) == (3, [])
+    typos.remove('cheese')
+    assert typos.lookup('chese', 1) == (1, ['chess'])
+
+    # Las palabras justo a una distancia mayor que la permitida no son correcciones
+    typos = DeletionIndex()
+    typos.add('abef')
+    assert typos.lookup('abc', 1) == (2, [])
+    assert typos.lookup('abc', 2) == (2, ['abef'])
+
+    index = InvertedIndex()
+    index.put(1, [('cheese', 1), ('#cheese', 1), ('cheap', 1)], 10, 0)
+    index.put(2, [('cheese', 1), ('chess', 1)], 10, 0)
+    assert index.correct('chee') == 'chee'
+    assert index.correct('chesse') == 'cheese'
+    assert index.correct('chezs') == 'chess'
+    assert index.correct('xyzzy') is None
+    index.put(3, [('developing', 1)], 10, 0)
+    assert index.correct('developer') is None
+
+
+def test_index_follows_database():
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+        user_t = User(email="emailT", pwd="passwordT", name="name")
+        user_t.save_to_db()
+        service_t = Service(title="cheese maker", user=user_t, description="I make #cheese", price=0)
+        service_t.save_to_db()
+
+        index = term_frequency.get_index()
+        assert index.loaded
+        assert index.get_coincidences('cheese', {service_t.id}) == [('#cheese', service_t.id, 1),
+                                                                  ('cheese', service_t.id, 1)]
+
+        service_t.description = "I make bread"
+        service_t.save_to_db()
+        assert index.get_coincidences('cheese', {service_t.id}) == [('cheese', service_t.id, 1)]
+
+        # Rebuilding from the database gives the same index
+        postings = {word: (list(ids), list(counts)) for word, (ids, counts) in index.postings.items()}
+        term_frequency.load_index()
+        assert {word: (list(ids), list(counts)) for word, (ids, counts) in index.postings.items()} == postings
+        assert index.documents[service_t.id].length == len("cheese maker") + len("I make bread")
+
+        db.drop_all()
+        assert not index.loaded
+
+
+def test_index_queue():
+    queue = IndexQueue()
+    done = []
+    release = threading.Event()
+
+    queue.put('block', release.wait)
+    for i in range(5):
+        queue.put(1, lambda i=i: done.append((1, i)))
+    queue.put(2, lambda: done.append((2, 0)))
+    assert len(queue) == 3
+    assert not queue.wait(timeout=0.01)
+
+    release.set()
+    assert queue.wait(timeout=5)
+    # Solo se ejecuta la última tarea de cada clave
+    assert done == [(1, 4), (2, 0)]
+
+
+def test_async_indexing():
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        app.config['SEARCH_INDEX_ASYNC'] = True
+
+        try:
+            user_t = User(email="emailT", pwd="passwordT", name="name")
+            user_t.save_to_db()
+            service_t = Service(title="cheese maker", user=user_t, description="I make cheese", price=0)
+            service_t.save_to_db()
+            service_t.description = "I make bread"
+            service_t.save_to_db()
+
+            assert term_frequency.wait_for_index(timeout=10)
+            index = term_frequency.get_index()
+            assert index.get_coincidences('bread', {service_t.id}) == [('bread', service_t.id, 1)]
+            assert db.session.query(term_frequency).filter(term_frequency.service_id == service_t.id).count() == 4
+        finally:
+            app.config['SEARCH_INDEX_ASYNC'] = False
+            db.drop_all()
+
+
+def test_reindex_command():
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+        user_t = User(email="emailT", pwd="passwordT", name="name")
+        user_t.save_to_db()
+        for i in range(5):
+            Service(title="cheese maker " + str(i), user=user_t, description="I make #cheese", price=0).save_to_db()
+
+        index = term_frequency.get_index()
+        postings = {word: (list(ids), list(counts)) for word, (ids, counts) in index.postings.items()}
+        rows = sorted(db.session.query(term_frequency.word, term_frequency.service_id, term_frequency.count))
+
+        # Se pierde el índice de un servicio, reindex lo reconstruye
+        db.session.query(term_frequency).filter(term_frequency.service_id == 1).delete()
+        db.session.commit()
+
+        for workers in ('0', '2'):
+            result = app.test_cli_runner().invoke(args=['reindex', '--batch-size', '2', '--workers', workers])
+            assert result.exit_code == 0
+            assert "Indexed 5 services" in result.output
+
+            assert sorted(db.session.query(term_frequency.word, term_frequency.service_id, term_frequency.count)) == rows
+            assert {word: (list(ids), list(counts)) for word, (ids, counts) in index.postings.items()} == postings
+
+        db.drop_all()
+
+
+def test_only_live_services_indexed():
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+        user_t = User(email="emailT", pwd="passwordT", name="name")
+        user_t.save_to_db()
+        old = Service(title="cheese maker", user=user_t, description="I make #cheese", price=0)
+        old.save_to_db()
+
+        # Nueva versión del servicio, como en el PUT
+        old.state = 2
+        old.save_to_db()
+        new = Service(title="cheese maker", user=user_t, description="I make #cheese and bread", price=0)
+        new.masterID = old.masterID
+        new.save_to_db()
+
+        index = term_frequency.get_index()
+        assert old.id not in index.documents
+        assert index.get_coincidences('bread', {old.id, new.id}) == [('bread', new.id, 1)]
+        assert db.session.query(term_frequency).filter(term_frequency.service_id == old.id).count() == 0
+        assert db.session.query(DocumentStats).filter(DocumentStats.service_id == old.id).count() == 0
+
+        # Filas que dejaban las versiones anteriores
+        db.session.add_all([term_frequency(word='cheese', service_id=old.id, count=1),
+                            DocumentStats(service_id=old.id, length=10, n_terms=1, state=2)])
+        db.session.commit()
+        term_frequency.load_index()
+        assert old.id not in index.documents
+
+        result = app.test_cli_runner().invoke(args=['compact-index'])
+        assert result.exit_code == 0
+        assert "Deleted 1 term_frequency rows and 1 document_stats rows" in result.output
+        assert db.session.query(term_frequency).filter(term_frequency.service_id == old.id).count() == 0
+
+        new.delete_from_db()
+        assert len(index.documents) == 0
+
+        db.drop_all()
+
+
+# Claves de ordenación calculadas en Python desde las relaciones, como se ordenaba antes de hacerlo en SQL
+reference_sort_keys = {
+    'price': lambda s: s.price,
+    'creation_date': lambda s: s.created_at,
+    'rating': lambda s: s.master_service.service_grade,
+    'popularity': lambda s: sum(len([c for c in b.contracts if c.state == 2]) for b in s.master_service.child_services)
+}
+
+
+def test_sort_matches():
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+        user_t = User(email="emailT", pwd="passwordT", name="name")
+        user_t.save_to_db()
+        services = []
+        for price, grade in [(3, 1.0), (1, 4.0), (3, 2.0), (2, 4.0), (1, 0.0)]:
+            s = Service(title="cheese", user=user_t, description="cheese", price=price)
+            s.save_to_db()
+            s.service_grade = grade
+            services.append(s)
+
+        # Nueva versión del segundo servicio, con contratos en las dos versiones
+        new = Service(title="cheese", user=user_t, description="cheese", price=5)
+        new.masterID = services[1].masterID
+        new.save_to_db()
+        services.append(new)
+        for s, state in [(services[1], 2), (new, 2), (services[3], 2), (services[3], 1), (services[0], 2)]:
+            db.session.add(ContractedService(user_email=user_t.email, service_id=s.id, state=state))
+        db.session.commit()
+        assert Service.count_completed_contracts() == 3
+        assert [s.completed_contracts for s in services] == [1, 2, 0, 1, 0, 0]
+
+        ids = [s.id for s in services]
+        for by in ['price', 'creation_date', 'rating', 'popularity']:
+            for reverse in [True, False]:
+                expected = sorted(services, key=reference_sort_keys[by], reverse=reverse)
+                assert sort_matches(Service, ids, {'by': by, 'reverse': reverse}) == [s.id for s in expected]
+
+        db.drop_all()
+
+
+def test_bm25_ranking():
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+        user_t = User(email="emailT", pwd="passwordT", name="name")
+        user_t.save_to_db()
+        long_s = Service(title="cheese", user=user_t, price=0,
+                         description="we sell bread, wine, fruit, vegetables, fish, meat and a bit of cheese")
+        short_s = Service(title="cheese", user=user_t, description="cheese cheese", price=0)
+        other_s = Service(title="bread", user=user_t, description="fresh bread", price=0)
+        for s in (long_s, short_s, other_s):
+            s.save_to_db()
+
+        index = term_frequency.get_index()
+        assert index.n_documents == 3
+        assert index.n_active == 3
+        assert DocumentStats.query.get(short_s.id).n_terms == 3
+
+        ranked = get_matches_text(Service.query, Service, "cheese", search_order=True, ranking='bm25')
+        assert [s.id for s in ranked] == [short_s.id, long_s.id]
+
+        other_s.state = 1
+        other_s.save_to_db()
+        assert index.n_active == 2
+        assert index.n_documents == 3
+
+        # Rebuilding from the stats table gives the same corpus statistics
+        term_frequency.load_index()
+        assert (index.n_documents, index.n_active, index.total_terms) == (3, 2, DocumentStats.query.with_entities(
+            func.sum(DocumentStats.n_terms)).scalar())
+
+        # Typos are corrected
+        ranked = get_matches_text(Service.query, Service, "chesse", search_order=True)
+        assert [s.id for s in ranked] == [short_s.id, long_s.id]
+        assert get_matches_text(Service.query, Service, "qwerty", search_order=True) == []
+
+        # Hashtags prefilter the candidates
+        tagged_s = Service(title="cheese", user=user_t, description="#cheese #french", price=0)
+        tagged_s.save_to_db()
+        ranked = get_matches_text(Service.query, Service, "cheese #french", search_order=True)
+        assert [s.id for s in ranked] == [tagged_s.id]
+        assert get_matches_text(Service.query, Service, "cheese #french #wine", search_order=True) == []
+        assert get_matches_text(Service.query, Service, "#french", search_order=True) == [tagged_s]
+
+        # Only the ids matched in the index are checked in the database, never the whole catalog
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            assert get_matches_text(Service.query, Service, "zzzunique", search_order=True) == []
+            assert statements == []
+            q = Service.query.filter(Service.description.like('%#french%'))
+            candidates = get_candidates(q, Service, term_frequency.get_index(), ['cheese'], [], chunk_size=1,
+                                        max_chunked=1)
+            assert candidates == {tagged_s.id}
+        finally:
+            event.remove(db.engine, "before_cursor_execute", record)
+        assert len(statements) == 3 and all(' IN (' in statement for statement in statements)
+
+        with pytest.raises(BadRequest):
+            get_matches_text(Service.query, Service, "cheese", search_order=True, ranking='pagerank')
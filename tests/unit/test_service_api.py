@@ -1,18 +1,27 @@
+import json
+from datetime import date, timedelta
+
 from init_app import init_app
 import pytest
+from sqlalchemy import event
 
+from models.service import Service
+from models.user import User
+from utils.search_cache import search_cache
 from utils.secure_request import request_with_login
 
 app, db = init_app("sqlite:///data_test.db")
 
 
 @pytest.fixture(scope='function', autouse=True)
-def client():
+def client(tmp_path):
+    app.config['IMAGE_STORE_PATH'] = str(tmp_path)
     with app.test_request_context():
         db.drop_all()
         db.create_all()
         db.session.commit()
         yield app.test_client()
+    app.config['IMAGE_STORE_PATH'] = None
 
 
 def test_empty_db_services(client):
@@ -308,3 +317,423 @@ def test_get_user_services(client):
 
     assert len (services) == 1
     assert services[0]['state'] == 1
+
+def test_search_pagination(client):
+
+    # Credentials for user
+    email1 = 'pepito@gmail.com'
+    pwd1 = '12345678'
+
+    user1_dict = {'email': email1, 'pwd': pwd1, 'name': 'Pepito', 'access': 1}
+    r = client.post("users", json=user1_dict)
+    assert r.status_code == 201
+
+    for i in range(1, 6):
+        service_dict = {'title': 'cheese ' * i, 'description': 'description', 'price': i}
+        r = request_with_login(login=client.post, request=client.post, url="services", json_r=service_dict,
+                               email=email1, pwd=pwd1)
+        assert r.status_code == 200
+
+    r = client.get("services/search", json={"search_text": "cheese"})
+    ranked = [s['id'] for s in r.get_json()]
+    assert len(ranked) == 5
+
+    # Following the cursors gives the same ranking
+    paged = []
+    cursor = None
+    while True:
+        search_request = {"search_text": "cheese", "limit": 2}
+        if cursor is not None:
+            search_request["cursor"] = cursor
+        r = client.get("services/search", json=search_request)
+        assert r.status_code == 200
+        assert len(r.get_json()) <= 2
+        paged += [s['id'] for s in r.get_json()]
+        cursor = r.headers.get('X-Next-Cursor')
+        if cursor is None:
+            break
+    assert paged == ranked
+
+    search_request = {"sort": {"by": "price", "reverse": True}, "limit": 3, "cursor": 3}
+    r = client.get("services/search", json=search_request)
+    assert [s['price'] for s in r.get_json()] == ['2.00', '1.00']
+    assert 'X-Next-Cursor' not in r.headers
+
+    r = client.get("services/" + email1 + "/service?limit=4")
+    assert len(r.get_json()) == 4
+    assert r.headers['X-Next-Cursor'] == '4'
+
+    r = client.get("services/search", json={"limit": "two"})
+    assert r.status_code == 400
+
+def test_service_feed(client):
+
+    # Credentials for user
+    email1 = 'pepito@gmail.com'
+    pwd1 = '12345678'
+
+    user1_dict = {'email': email1, 'pwd': pwd1, 'name': 'Pepito', 'access': 1}
+    r = client.post("users", json=user1_dict)
+    assert r.status_code == 201
+
+    ids = []
+    for i in range(1, 7):
+        service_dict = {'title': 'service ' + str(i), 'description': 'description', 'price': i}
+        r = request_with_login(login=client.post, request=client.post, url="services", json_r=service_dict,
+                               email=email1, pwd=pwd1)
+        assert r.status_code == 200
+        ids.append(r.get_json()['added_service_id'])
+
+    # The first service is the newest one, the last one is paused
+    Service.query.get(ids[0]).created_at = date.today() + timedelta(days=1)
+    Service.query.get(ids[5]).state = 1
+    db.session.commit()
+    expected = [ids[0], ids[4], ids[3], ids[2], ids[1]]
+
+    r = client.get("services/feed?limit=2")
+    assert r.status_code == 200
+    feed = [s['id'] for s in r.get_json()]
+    cursor = r.headers['X-Next-Cursor']
+
+    # A service created while paginating doesn't move the next pages
+    r = request_with_login(login=client.post, request=client.post, url="services",
+                           json_r={'title': 'new', 'description': 'description', 'price': 1}, email=email1, pwd=pwd1)
+    assert r.status_code == 200
+
+    while cursor is not None:
+        r = client.get("services/feed?limit=2&cursor=" + cursor)
+        assert r.status_code == 200
+        assert len(r.get_json()) <= 2
+        feed += [s['id'] for s in r.get_json()]
+        cursor = r.headers.get('X-Next-Cursor')
+    assert feed == expected
+
+    r = client.get("services/feed")
+    assert len(r.get_json()) == 6
+    assert 'X-Next-Cursor' not in r.headers
+
+    for args in ("limit=0", "limit=1000", "limit=two", "cursor=yesterday", "cursor=2022-01-01_x"):
+        r = client.get("services/feed?" + args)
+        assert r.status_code == 400
+
+
+def test_ndjson_stream(client):
+
+    # Credentials for user
+    email1 = 'pepito@gmail.com'
+    pwd1 = '12345678'
+
+    user1_dict = {'email': email1, 'pwd': pwd1, 'name': 'Pepito', 'access': 1}
+    r = client.post("users", json=user1_dict)
+    assert r.status_code == 201
+
+    for i in range(1, 6):
+        service_dict = {'title': 'cheese ' * i, 'description': 'description', 'price': i}
+        r = request_with_login(login=client.post, request=client.post, url="services", json_r=service_dict,
+                               email=email1, pwd=pwd1)
+        assert r.status_code == 200
+
+    def ndjson(r):
+        assert r.status_code == 200, r.get_data()
+        assert r.mimetype == 'application/x-ndjson'
+        return [json.loads(line) for line in r.get_data(as_text=True).splitlines()]
+
+    headers = {'Accept': 'application/x-ndjson'}
+    assert ndjson(client.get("services", headers=headers)) == client.get("services").get_json()
+
+    # The stream has the same services as the json list, also following the cursors
+    for search_request in ({}, {"search_text": "cheese"}, {"search_text": "cheese", "sort": {"by": "price"}},
+                           {"filters": {"price": {"min": 2}}, "sort": {"by": "price", "reverse": True}},
+                           {"search_text": "cheese", "limit": 2, "cursor": 2}):
+        expected = client.get("services/search", json=search_request)
+        r = client.get("services/search", json=search_request, headers=headers)
+        assert ndjson(r) == expected.get_json()
+        assert r.headers.get('X-Next-Cursor') == expected.headers.get('X-Next-Cursor')
+
+    r = client.get("services/" + email1 + "/service?limit=3", headers=headers)
+    assert len(ndjson(r)) == 3
+    assert r.headers['X-Next-Cursor'] == '3'
+
+    r = client.get("services/search", json={"search_text": "cheese", "facets": True}, headers=headers)
+    assert r.status_code == 400
+
+
+def test_batched_serialization(client):
+
+    for i in range(1, 4):
+        r = client.post("users", json={'email': f'user{i}@gmail.com', 'pwd': '12345678', 'name': f'User {i}',
+                                       'access': 1})
+        assert r.status_code == 201
+        for j in range(i):
+            service_dict = {'title': 'service', 'description': 'description', 'price': j}
+            r = request_with_login(login=client.post, request=client.post, url="services", json_r=service_dict,
+                                   email=f'user{i}@gmail.com', pwd='12345678')
+            assert r.status_code == 200
+
+    # The listings have the same shape as the detail of a service
+    services = client.get("services").get_json()
+    assert len(services) == 6
+    for service in services:
+        assert service == client.get("services/" + str(service['id'])).get_json()
+        assert service['user_name'] == 'User ' + service['user_email'][4]
+    searched = client.get("services/search", json={"search_text": "service"}).get_json()
+    assert sorted(searched, key=lambda service: service['id']) == sorted(services, key=lambda service: service['id'])
+
+    # The number of queries doesn't depend on the number of services
+    statements = []
+
+    def count(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", count)
+    try:
+        counts = []
+        for limit in (1, 6):
+            search_cache.bump_version()
+            statements.clear()
+            r = client.get("services/search?limit=" + str(limit))
+            assert len(r.get_json()) == limit
+            counts.append(len(statements))
+    finally:
+        event.remove(db.engine, "before_cursor_execute", count)
+    assert counts[0] == counts[1]
+
+
+def test_sparse_fieldsets(client):
+
+    email1 = 'pepito@gmail.com'
+    pwd1 = '12345678'
+    r = client.post("users", json={'email': email1, 'pwd': pwd1, 'name': 'Pepito', 'access': 1})
+    assert r.status_code == 201
+
+    for i in range(1, 4):
+        service_dict = {'title': 'cheese ' + str(i), 'description': 'big description', 'price': i,
+                        'image1': 'data:image/png;base64,' + 'A' * 1000}
+        r = request_with_login(login=client.post, request=client.post, url="services", json_r=service_dict,
+                               email=email1, pwd=pwd1)
+        assert r.status_code == 200
+        service_id = r.get_json()['added_service_id']
+
+    full = client.get("services/" + str(service_id)).get_json()
+    r = client.get("services/" + str(service_id) + "?fields=title,price,user_name")
+    assert r.get_json() == {'id': service_id, 'title': full['title'], 'price': full['price'], 'user_name': 'Pepito'}
+
+    for r in (client.get("services?fields=title, price"), client.get("services/feed?fields=title,price"),
+              client.get("services/search", json={"search_text": "cheese", "fields": ["title", "price"]}),
+              client.get("services/search", json={"sort": {"by": "price"}, "fields": "title,price"}),
+              client.get("services/" + email1 + "/service?fields=title,price")):
+        assert r.status_code == 200
+        services = r.get_json()
+        assert len(services) == 3
+        assert all(service.keys() == {'id', 'title', 'price'} for service in services)
+
+    # The columns that are not asked are not read
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", record)
+    try:
+        search_cache.bump_version()
+        r = client.get("services/search?fields=title,price")
+        assert len(r.get_json()) == 3
+    finally:
+        event.remove(db.engine, "before_cursor_execute", record)
+    assert not any('image1' in statement or 'description' in statement for statement in statements)
+
+    r = client.get("services/search?fields=title,password")
+    assert r.status_code == 400
+    r = client.get("services/search", json={"fields": [1, 2]})
+    assert r.status_code == 400
+    r = client.get("services/" + str(service_id) + "?fields=contracts")
+    assert r.status_code == 400
+
+    # A json content type without body asks for all the fields
+    headers = {'Content-Type': 'application/json'}
+    r = client.get("services", headers=headers)
+    assert r.status_code == 200 and len(r.get_json()) == 3
+    r = client.get("services/" + str(service_id), headers=headers)
+    assert r.status_code == 200 and r.get_json() == full
+
+
+def test_search_cache(client):
+
+    # Credentials for user
+    email1 = 'pepito@gmail.com'
+    pwd1 = '12345678'
+
+    user1_dict = {'email': email1, 'pwd': pwd1, 'name': 'Pepito', 'access': 1}
+    r = client.post("users", json=user1_dict)
+    assert r.status_code == 201
+
+    service1_dict = {'title': 'cheese maker', 'description': 'description', 'price': 1}
+    r = request_with_login(login=client.post, request=client.post, url="services", json_r=service1_dict, email=email1,
+                           pwd=pwd1)
+    assert r.status_code == 200
+
+    stats = search_cache.stats()
+    r = client.get("services/search", json={"search_text": "cheese"})
+    assert len(r.get_json()) == 1
+    r = client.get("services/search", json={"search_text": "cheese"})
+    assert len(r.get_json()) == 1
+    assert search_cache.stats()['hits'] == stats['hits'] + 1
+    assert search_cache.stats()['misses'] == stats['misses'] + 1
+
+    # The owner sees other services than the public
+    r = request_with_login(login=client.post, request=client.get, url="services/" + email1 + "/service", json_r={},
+                           email=email1, pwd=pwd1)
+    assert search_cache.stats()['misses'] == stats['misses'] + 2
+
+    # Writing a service invalidates the cache
+    service2_dict = {'title': 'cheese seller', 'description': 'description', 'price': 1}
+    r = request_with_login(login=client.post, request=client.post, url="services", json_r=service2_dict, email=email1,
+                           pwd=pwd1)
+    assert r.status_code == 200
+    r = client.get("services/search", json={"search_text": "cheese"})
+    assert len(r.get_json()) == 2
+
+    # Only admins can see the stats
+    r = request_with_login(login=client.post, request=client.get, url="services/search/cache", json_r={},
+                           email=email1, pwd=pwd1)
+    assert r.status_code == 403
+
+    # Any committed change of the catalog invalidates the cache, also the ones of routes and code that don't bump it
+    email_a = 'admin@gmail.com'
+    pwd_a = 'qqweas'
+    User(email=email_a, pwd=User.hash_password(pwd_a), name="MaxAdm", access=9, verified_email=True).save_to_db()
+    service_id = Service.query.filter_by(title='cheese maker').one().id
+
+    def searched(key):
+        r = client.get("services/search", json={"search_text": "cheese"})
+        assert r.status_code == 200
+        return {s['id']: s[key] for s in r.get_json()}[service_id]
+
+    assert searched('service_grade') == 0
+    r = request_with_login(login=client.post, request=client.post, url="reviews/" + str(service_id),
+                           json_r={'stars': 4}, email=email_a, pwd=pwd_a)
+    assert r.status_code == 200
+    assert searched('service_grade') == 4
+
+    assert searched('price') == '1.00'
+    Service.query.get(service_id).price = 7
+    db.session.commit()
+    assert searched('price') == '7.00'
+
+
+def test_suggest(client):
+
+    # Credentials for user
+    email1 = 'pepito@gmail.com'
+    pwd1 = '12345678'
+
+    user1_dict = {'email': email1, 'pwd': pwd1, 'name': 'Pepito', 'access': 1}
+    r = client.post("users", json=user1_dict)
+    assert r.status_code == 201
+
+    for title in ['cheese maker', 'cheese seller', 'chess teacher #chess']:
+        service_dict = {'title': title, 'description': 'description', 'price': 1}
+        r = request_with_login(login=client.post, request=client.post, url="services", json_r=service_dict,
+                               email=email1, pwd=pwd1)
+        assert r.status_code == 200
+
+    r = client.get("services/suggest?prefix=Che")
+    assert r.status_code == 200
+    assert r.get_json() == ['cheese', 'chess']
+
+    r = client.get("services/suggest?prefix=%23&n=1")
+    assert r.get_json() == ['#chess']
+
+    r = client.get("services/suggest")
+    assert r.status_code == 400
+    r = client.get("services/suggest?prefix=che&n=0")
+    assert r.status_code == 400
+
+
+def test_search_explain(client):
+
+    # Credentials for user and admin
+    email1 = 'pepito@gmail.com'
+    pwd1 = '12345678'
+    email_a = 'admin@gmail.com'
+    pwd_a = 'qqweas'
+
+    user1_dict = {'email': email1, 'pwd': pwd1, 'name': 'Pepito', 'access': 1}
+    r = client.post("users", json=user1_dict)
+    assert r.status_code == 201
+    user_a = User(email=email_a, pwd=User.hash_password(pwd_a), name="MaxAdm", access=9, verified_email=True)
+    user_a.save_to_db()
+
+    for title in ['cheese maker #maker', 'cheese seller', 'bread maker #maker']:
+        service_dict = {'title': title, 'description': 'description', 'price': 1}
+        r = request_with_login(login=client.post, request=client.post, url="services", json_r=service_dict,
+                               email=email1, pwd=pwd1)
+        assert r.status_code == 200
+
+    search = {"search_text": "cheese #maker", "explain": True}
+    r = request_with_login(login=client.post, request=client.get, url="services/search", json_r=search,
+                           email=email_a, pwd=pwd_a)
+    assert r.status_code == 200
+    body = r.get_json()
+    assert [s['title'] for s in body['services']] == ['cheese maker #maker']
+
+    stages = {stage['stage']: stage for stage in body['explain']['stages']}
+    for name in ['tokenization', 'candidates', 'coincidences', 'scoring', 'ranking', 'serialization']:
+        assert stages[name]['ms'] >= 0
+    assert stages['coincidences']['word'] == 'cheese'
+    assert stages['coincidences']['rows'] == 1
+    assert stages['serialization']['rows'] == 1
+    assert any('FROM services' in statement for statement in body['explain']['sql'])
+
+    # With sort the threshold cut and the sort are timed
+    search = {"search_text": "cheese", "sort": {"by": "price"}, "explain": True}
+    r = request_with_login(login=client.post, request=client.get, url="services/search", json_r=search,
+                           email=email_a, pwd=pwd_a)
+    stages = [stage['stage'] for stage in r.get_json()['explain']['stages']]
+    assert 'threshold cut' in stages and 'sort' in stages
+
+    # Only admins can explain a search
+    r = request_with_login(login=client.post, request=client.get, url="services/search", json_r=search,
+                           email=email1, pwd=pwd1)
+    assert r.status_code == 403
+
+
+def test_search_facets(client):
+
+    # Credentials for user
+    email1 = 'pepito@gmail.com'
+    pwd1 = '12345678'
+
+    user1_dict = {'email': email1, 'pwd': pwd1, 'name': 'Pepito', 'access': 1}
+    r = client.post("users", json=user1_dict)
+    assert r.status_code == 201
+
+    for title, price, requires_place in [('cheese maker #cheese #food', 5, True), ('cheese seller #cheese', 30, False),
+                                         ('bread maker #food', 2000, False)]:
+        service_dict = {'title': title, 'description': 'description', 'price': price, 'requiresPlace': requires_place}
+        r = request_with_login(login=client.post, request=client.post, url="services", json_r=service_dict,
+                               email=email1, pwd=pwd1)
+        assert r.status_code == 200
+
+    r = client.get("services/search", json={"search_text": "cheese", "facets": True, "limit": 1})
+    assert r.status_code == 200
+    body = r.get_json()
+    assert len(body['services']) == 1
+
+    # Facets count all the results, not only the page
+    facets = body['facets']
+    assert facets['total'] == 2
+    assert {'min': 0, 'max': 10, 'count': 1} in facets['price']
+    assert {'min': 25, 'max': 50, 'count': 1} in facets['price']
+    assert facets['rating'][0]['count'] == 2
+    assert facets['hashtags'] == [{'hashtag': '#cheese', 'count': 2}, {'hashtag': '#food', 'count': 1}]
+    assert facets['requiresPlace'] == {'true': 1, 'false': 1}
+
+    # Without search text the facets count the services that pass the filters
+    r = client.get("services/search", json={"filters": {"price": {"min": 10}}, "facets": True})
+    facets = r.get_json()['facets']
+    assert facets['total'] == 2
+    assert facets['price'][-1] == {'min': 1000, 'max': None, 'count': 1}
+
+    r = client.get("services/search?facets=true")
+    assert r.get_json()['facets']['total'] == 3
@@ -4,6 +4,7 @@ from init_app import init_app
 from models.service import Service
 from models.user import User
 from routes.services import service_schema_all
+from sqlalchemy import inspect, text
 from sqlalchemy.exc import IntegrityError
 import json
 
@@ -92,3 +93,31 @@ def test_delete_service():
         # Comprovamos que al borrar el servicio el usuario sigue existiendo
         assert Service.query.all()[0].state == 2
 
+
+
+def test_backfill_popularity_upgrades_table():
+    """
+    This method tests that backfill-popularity adds the completed_contracts column to an older services table
+    """
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        user_t = User(email="emailT", pwd="passwordT", name="name")
+        user_t.save_to_db()
+        Service(title="titleT", user=user_t, description="descriptionT", price=0).save_to_db()
+
+        # Tabla de servicios como la crea la versión anterior
+        db.session.execute(text("DROP INDEX ix_services_completed_contracts"))
+        db.session.execute(text("ALTER TABLE services DROP COLUMN completed_contracts"))
+        db.session.commit()
+        db.session.expunge_all()
+
+        result = app.test_cli_runner().invoke(args=['backfill-popularity'])
+        assert result.exit_code == 0
+        assert 'Added the completed_contracts column' in result.output
+        assert Service.query.one().completed_contracts == 0
+        assert 'ix_services_completed_contracts' in {i['name'] for i in inspect(db.engine).get_indexes('services')}
+
+        result = app.test_cli_runner().invoke(args=['backfill-popularity'])
+        assert result.exit_code == 0 and 'Added' not in result.output
+        db.drop_all()
@@ -0,0 +1,75 @@
+import random
+from heapq import nlargest
+
+import pytest
+
+from utils.search_backends import score_words
+from utils.search_index import InvertedIndex
+from utils.sharded_search import ShardedEngine, np
+
+pytestmark = pytest.mark.skipif(np is None, reason="numpy not installed")
+
+vocabulary = ['cheese', 'cheesecake', 'maker', 'make', 'program', 'programmer', 'programs', 'computer', 'bread',
+              'baker', 'bake', 'wine', '#cheese', '#bread', 'fresh', 'fish', 'fisher', 'garden', 'gardener', 'paint']
+queries = [['cheese'], ['make', 'cheese'], ['program'], ['bake', 'fresh'], ['er'], ['garden', 'paint', 'wine'],
+           ['unknown'], ['fish', 'cheese', 'make']]
+
+
+def random_service(rng):
+    words = rng.sample(vocabulary, rng.randint(1, 8))
+    counts = sorted((word, rng.randint(1, 5)) for word in words)
+    return counts, sum(len(word) * count for word, count in counts) + rng.randint(0, 50)
+
+
+def assert_same_scores(index, engine, rng):
+    for words in queries:
+        all_ids = list(index.documents)
+        for candidates in (set(all_ids), set(rng.sample(all_ids, len(all_ids) // 2))):
+            for search_order in (True, False):
+                for ranking in ('tfidf', 'bm25'):
+                    expected = score_words(index, words, candidates, search_order, ranking)
+                    scores = engine.score(index, words, candidates, search_order, ranking, 3)
+
+                    assert scores.keys() == expected.keys()
+                    for service_id, score in expected.items():
+                        assert scores[service_id] == pytest.approx(score)
+
+            # Cada shard (y los servicios modificados) devuelve sus 5 mejores, la mezcla contiene los 5 mejores
+            expected = score_words(index, words, candidates, True, 'tfidf')
+            scores = engine.score(index, words, candidates, True, 'tfidf', 3, top_k=5)
+            assert len(scores) <= 4 * 5
+            assert sorted(nlargest(5, scores.values())) == pytest.approx(sorted(nlargest(5, expected.values())))
+
+
+def test_same_scores_as_python_scoring():
+    rng = random.Random(7)
+    index = InvertedIndex()
+    engine = ShardedEngine(min_delta=20, delta_ratio=0.1)
+    index.add_listener(engine)
+
+    try:
+        for service_id in range(1, 201):
+            counts, length = random_service(rng)
+            index.put(service_id, counts, length, rng.choice([0, 0, 0, 1]))
+        assert_same_scores(index, engine, rng)
+        shards = engine.shards
+
+        # Updates are scored in this process until the shards are written again
+        for service_id in rng.sample(range(1, 201), 10):
+            counts, length = random_service(rng)
+            index.put(service_id, counts + [('newword', 2)], length + 7, 0)
+        index.remove(3)
+        index.put(500, [('cheese', 3), ('newword', 1)], 30, 0)
+        assert_same_scores(index, engine, rng)
+        assert engine.shards == shards
+        assert engine.score(index, ['newword'], {500}, True, 'tfidf', 3).keys() == {500}
+
+        # Many updates rewrite the shards
+        for service_id in rng.sample(range(1, 201), 40):
+            counts, length = random_service(rng)
+            index.put(service_id, counts, length, 0)
+        assert_same_scores(index, engine, rng)
+        assert engine.shards != shards
+        assert len(engine.dirty) == 0
+    finally:
+        engine.close()
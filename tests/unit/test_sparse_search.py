@@ -0,0 +1,66 @@
+import random
+
+import pytest
+
+from utils.search_index import InvertedIndex
+from utils.search_backends import score_words
+from utils.sparse_search import SparseEngine, sparse
+
+pytestmark = pytest.mark.skipif(sparse is None, reason="scipy not installed")
+
+vocabulary = ['cheese', 'cheesecake', 'maker', 'make', 'program', 'programmer', 'programs', 'computer', 'bread',
+              'baker', 'bake', 'wine', '#cheese', '#bread', 'fresh', 'fish', 'fisher', 'garden', 'gardener', 'paint']
+queries = [['cheese'], ['make', 'cheese'], ['program'], ['bake', 'fresh'], ['er'], ['garden', 'paint', 'wine'],
+           ['unknown'], ['fish', 'cheese', 'make']]
+
+
+def random_service(rng):
+    words = rng.sample(vocabulary, rng.randint(1, 8))
+    counts = sorted((word, rng.randint(1, 5)) for word in words)
+    return counts, sum(len(word) * count for word, count in counts) + rng.randint(0, 50)
+
+
+def ranking(scores):
+    return [service_id for service_id, _ in sorted(scores.items(), key=lambda x: (-x[1], x[0]))]
+
+
+def assert_same_scores(index, engine, rng):
+    for words in queries:
+        all_ids = list(index.documents)
+        for candidates in (set(all_ids), set(rng.sample(all_ids, len(all_ids) // 2))):
+            for search_order in (True, False):
+                expected = score_words(index, words, candidates, search_order, 'tfidf')
+                scores = engine.score(index, words, candidates, search_order)
+
+                assert ranking(scores) == ranking(expected)
+                for service_id, score in expected.items():
+                    assert scores[service_id] == pytest.approx(score)
+
+
+def test_same_ranking_as_python_scoring():
+    rng = random.Random(42)
+    index = InvertedIndex()
+    engine = SparseEngine(min_delta=20, delta_ratio=0.1)
+    index.add_listener(engine)
+
+    for service_id in range(1, 201):
+        counts, length = random_service(rng)
+        index.put(service_id, counts, length, rng.choice([0, 0, 0, 1]))
+    assert_same_scores(index, engine, rng)
+
+    # Updates go to the delta segment
+    for service_id in rng.sample(range(1, 201), 10):
+        counts, length = random_service(rng)
+        index.put(service_id, counts + [('newword', 2)], length + 7, 0)
+    index.remove(3)
+    index.put(500, [('cheese', 3), ('newword', 1)], 30, 0)
+    assert_same_scores(index, engine, rng)
+    assert engine.delta is not None
+    assert engine.score(index, ['newword'], {500}, True).keys() == {500}
+
+    # A big delta is merged into the base
+    for service_id in rng.sample(range(1, 201), 40):
+        counts, length = random_service(rng)
+        index.put(service_id, counts, length, 0)
+    assert_same_scores(index, engine, rng)
+    assert engine.delta is None
@@ -0,0 +1,33 @@
+import pytest
+
+from utils.tokenizer import tokenize, tokenize_search, token_pattern
+
+texts = ["I'm a programmer that makes programs",
+         "i can program your computer. I like #cheEse!!!",
+         "Ñandú, café y #Año_Nuevo: a b c d_e 12 x1 #a #ab",
+         "",
+         "  !! ##double #hash-tag end#tag"]
+
+
+def test_tokenize():
+    assert tokenize("I like cheese. CHEESE, #cheese!") == [('#cheese', 1), ('cheese', 2), ('like', 1)]
+    assert tokenize("a b") == []
+
+
+def test_tokenize_search():
+    assert tokenize_search("Cheese maker #Cheese cheese #tasty") == (('cheese', 'maker'), ('#cheese', '#tasty'))
+    assert tokenize_search("") == ((), ())
+
+
+def test_same_tokens_as_count_vectorizer():
+    text = pytest.importorskip("sklearn.feature_extraction.text")
+
+    for s in texts:
+        cv = text.CountVectorizer(token_pattern=token_pattern)
+        try:
+            cv_matrix = cv.fit_transform([s.lower()])
+            expected = [(word, int(count)) for word, count in zip(cv.get_feature_names_out(), cv_matrix.toarray()[0])]
+        except ValueError:
+            expected = []
+
+        assert tokenize(s) == expected
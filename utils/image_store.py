@@ -0,0 +1,223 @@
+import base64
+import binascii
+import hashlib
+import os
+import re
+import tempfile
+
+from flask import current_app, send_file, url_for
+from sqlalchemy import or_
+from werkzeug.exceptions import BadRequest
+
+from database import db
+
+hash_pattern = re.compile(r'^[0-9a-f]{64}$')
+# Lo que se guarda en las columnas puede ser el hash o la url con la que se sirve la imagen
+stored_pattern = re.compile(r'^(?:/images/)?([0-9a-f]{64})$')
+data_url_pattern = re.compile(r'^data:([^;,]*)(?:;[^;,]*)*;base64,', re.IGNORECASE)
+
+# Firmas de los formatos de imagen, el tipo que declara el cliente no se usa para servirlas
+signatures = [
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'BM', 'image/bmp'),
+]
+
+
+def sniff_mimetype(head):
+    """
+    :param head: first bytes of an image
+    :return: mimetype of the image, application/octet-stream if the format is not known
+    """
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    for signature, mimetype in signatures:
+        if head.startswith(signature):
+            return mimetype
+    return 'application/octet-stream'
+
+
+class ImageStore:
+    """
+    Interface of the image stores. Images are addressed by the sha256 of their content, so an image uploaded
+    several times is stored once and the rows only keep the hash.
+    """
+
+    def put(self, data):
+        """
+        Stores an image, if it isn't already stored
+        :param data: bytes of the image
+        :return: hash of the image
+        """
+        raise NotImplementedError
+
+    def exists(self, image_hash):
+        """
+        :param image_hash: hash of an image
+        :return: True if the image is stored
+        """
+        raise NotImplementedError
+
+    def send(self, image_hash, max_age):
+        """
+        :param image_hash: hash of a stored image
+        :param max_age: seconds the image can be cached
+        :return: Response with the image, answering conditional and range requests
+        """
+        raise NotImplementedError
+
+
+class LocalImageStore(ImageStore):
+    """
+    Stores the images as files of a local directory, in subdirectories named by the first two characters of
+    the hash
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, image_hash):
+        return os.path.join(self.root, image_hash[:2], image_hash)
+
+    def put(self, data):
+        image_hash = hashlib.sha256(data).hexdigest()
+        path = self.path(image_hash)
+        if not os.path.exists(path):
+            # Se escribe en un fichero temporal y se renombra, nunca se sirve una imagen a medio escribir
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                # mkstemp crea el fichero con permisos 0600, las imágenes son públicas
+                os.chmod(tmp_path, 0o644)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        return image_hash
+
+    def exists(self, image_hash):
+        return hash_pattern.match(image_hash) is not None and os.path.isfile(self.path(image_hash))
+
+    def send(self, image_hash, max_age):
+        path = self.path(image_hash)
+        with open(path, 'rb') as f:
+            head = f.read(16)
+        return send_file(path, mimetype=sniff_mimetype(head), conditional=True, etag=image_hash, max_age=max_age)
+
+
+image_stores = {
+    'local': LocalImageStore,
+}
+opened_stores = {}  # (tipo, ruta) -> store
+
+
+def get_image_store():
+    """
+    :return: the image store selected by the IMAGE_STORE and IMAGE_STORE_PATH config of the app
+    """
+    kind = current_app.config.get('IMAGE_STORE', 'local')
+    path = current_app.config.get('IMAGE_STORE_PATH') or os.path.join(current_app.instance_path, 'images')
+    if (kind, path) not in opened_stores:
+        opened_stores[(kind, path)] = image_stores[kind](path)
+    return opened_stores[(kind, path)]
+
+
+def store_image(value):
+    """
+    Converts an image sent by a client into the value kept in the database. Data URLs are decoded and stored
+    in the image store, hashes (or urls of /images) of stored images are kept and other values (p.e. urls of
+    other sites) are kept as they are
+    :param value: image sent by the client
+    :return: hash of the image, value or None
+    """
+    if not value:
+        return None
+    if not isinstance(value, str):
+        raise BadRequest('images must be strings!')
+
+    data_url = data_url_pattern.match(value)
+    if data_url:
+        try:
+            data = base64.b64decode(value[data_url.end():], validate=True)
+        except (binascii.Error, ValueError):
+            raise BadRequest('invalid base64 image!')
+        return get_image_store().put(data)
+
+    stored = stored_pattern.match(value)
+    if stored:
+        if not get_image_store().exists(stored.group(1)):
+            raise BadRequest('image ' + stored.group(1) + ' not found!')
+        return stored.group(1)
+    return value
+
+
+def store_images(data, fields):
+    """
+    Stores the images of a json sent by a client, see store_image
+    :param data: dict sent by the client
+    :param fields: names of the image fields
+    :return: data with the images replaced by the values kept in the database
+    """
+    return {key: store_image(value) if key in fields else value for key, value in data.items()}
+
+
+def image_urls(data, fields):
+    """
+    Replaces the stored images of a serialized object by their urls, see image_url
+    :param data: serialized object
+    :param fields: names of the image fields
+    :return: data
+    """
+    for key in fields:
+        if key in data:
+            data[key] = image_url(data[key])
+    return data
+
+
+def image_url(value):
+    """
+    :param value: image kept in the database
+    :return: the url where the image is served if it is stored, else the value
+    """
+    if value and hash_pattern.match(value):
+        return url_for('images.get_image', image_hash=value)
+    return value
+
+
+def migrate_images(model, key, columns, batch_size=100, echo=print):
+    """
+    Moves the data URLs kept in the image columns of a table to the image store, replacing them by their hash
+    :param model: model of the table
+    :param key: primary key column of the table, the rows are read in batches ordered by it
+    :param columns: image columns
+    :param batch_size: number of rows updated at once
+    :param echo: function used to report the progress
+    :return: number of images moved
+    """
+    n_images = 0
+    last = None
+    while True:
+        q = model.query.filter(or_(*(column.like('data:%') for column in columns)))
+        if last is not None:
+            q = q.filter(key > last)
+        batch = q.order_by(key).limit(batch_size).all()
+        if not batch:
+            break
+        last = getattr(batch[-1], key.key)
+
+        for row in batch:
+            for column in columns:
+                value = getattr(row, column.key)
+                if value and data_url_pattern.match(value):
+                    try:
+                        setattr(row, column.key, store_image(value))
+                        n_images += 1
+                    except BadRequest:
+                        echo(f"{model.__tablename__} {getattr(row, key.key)}: invalid {column.key}, not moved")
+        db.session.commit()
+        echo(f"{model.__tablename__}: {n_images} images moved")
+    return n_images
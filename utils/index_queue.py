@@ -0,0 +1,65 @@
+import logging
+from collections import OrderedDict
+from threading import Condition, Thread
+
+logger = logging.getLogger(__name__)
+
+
+class IndexQueue:
+    """
+    Queue of indexing tasks drained by a worker thread. Tasks have a key (p.e. the id of the service) and a
+    new task replaces the pending one with the same key, so a service saved several times is indexed once.
+    """
+
+    def __init__(self):
+        self.condition = Condition()
+        self.pending = OrderedDict()  # key -> task
+        self.running = 0
+        self.worker = None
+
+    def put(self, key, task):
+        """
+        Enqueues a task
+        :param key: key of the task, pending tasks with the same key are discarded
+        :param task: callable without arguments
+        """
+        with self.condition:
+            self.pending[key] = task
+
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = Thread(target=self._run, name="index-queue", daemon=True)
+                self.worker.start()
+
+            self.condition.notify_all()
+
+    def wait(self, timeout=None):
+        """
+        Waits until all the enqueued tasks are done
+        :param timeout: max seconds to wait, None waits forever
+        :return: True if the queue is empty, False if the timeout expired
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.pending and self.running == 0, timeout)
+
+    def __len__(self):
+        with self.condition:
+            return len(self.pending) + self.running
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending)
+                _, task = self.pending.popitem(last=False)
+                self.running += 1
+
+            try:
+                task()
+            except Exception:
+                logger.exception("Indexing task failed")
+            finally:
+                with self.condition:
+                    self.running -= 1
+                    self.condition.notify_all()
+
+
+index_queue = IndexQueue()
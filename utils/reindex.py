@@ -0,0 +1,83 @@
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+
+from database import db
+from models.search import term_frequency, DocumentStats
+from models.service import Service
+from utils.search_backends import get_search_backend
+from utils.search_cache import search_cache
+from utils.tokenizer import tokenize
+
+
+def reindex(batch_size=1000, workers=0, echo=print):
+    """
+    Rebuilds the term_frequency and document_stats tables from the live services with bulk inserts, batch by batch,
+    and then reloads the in-memory index and rebuilds what the search backend keeps apart (p.e. the FTS5 table). The
+    tables are replaced in a single transaction.
+    :param batch_size: number of services tokenized and inserted at once
+    :param workers: number of processes used to tokenize, 0 or 1 tokenizes in this process
+    :param echo: function used to report the progress
+    :return: (number of services, number of term_frequency rows, seconds)
+    """
+    start = perf_counter()
+    n_services = n_rows = 0
+
+    db.session.query(term_frequency).delete()
+    db.session.query(DocumentStats).delete()
+
+    pool = ProcessPoolExecutor(workers) if workers > 1 else None
+    try:
+        last_id = 0
+        while True:
+            batch = db.session.query(Service.id, Service.title, Service.description, Service.state) \
+                .filter(Service.id > last_id, Service.state != 2).order_by(Service.id).limit(batch_size).all()
+            if not batch:
+                break
+            last_id = batch[-1].id
+
+            texts = [title + ' ' + description for _, title, description, _ in batch]
+            if pool is None:
+                all_counts = map(tokenize, texts)
+            else:
+                all_counts = pool.map(tokenize, texts, chunksize=max(1, len(texts) // (4 * workers)))
+
+            rows, stats = [], []
+            for (service_id, title, description, state), counts in zip(batch, all_counts):
+                rows.extend({'word': word, 'service_id': service_id, 'count': count} for word, count in counts)
+                stats.append({'service_id': service_id, 'length': len(title) + len(description),
+                              'n_terms': sum(count for _, count in counts), 'state': state})
+
+            db.session.bulk_insert_mappings(term_frequency, rows)
+            db.session.bulk_insert_mappings(DocumentStats, stats)
+
+            n_services += len(batch)
+            n_rows += len(rows)
+            elapsed = perf_counter() - start
+            echo(f"{n_services} services, {n_rows} rows, {n_services / elapsed:.0f} services/s")
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    db.session.commit()
+    term_frequency.load_index()
+    get_search_backend().rebuild()
+    search_cache.bump_version()
+
+    elapsed = perf_counter() - start
+    echo(f"Indexed {n_services} services ({n_rows} rows) in {elapsed:.2f}s")
+    return n_services, n_rows, elapsed
+
+
+def compact(echo=print):
+    """
+    Purges the search index rows of services that are deleted, replaced by a newer version or don't exist
+    and reloads the in-memory index
+    :param echo: function used to report the result
+    :return: (number of term_frequency rows deleted, number of document_stats rows deleted)
+    """
+    n_rows, n_stats = get_search_backend().compact()
+    term_frequency.load_index()
+    search_cache.bump_version()
+
+    echo(f"Deleted {n_rows} term_frequency rows and {n_stats} document_stats rows")
+    return n_rows, n_stats
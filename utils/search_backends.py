@@ -0,0 +1,335 @@
+from collections import defaultdict
+from math import log
+
+from flask import current_app
+from sqlalchemy import event, func, text
+from sqlalchemy.sql import column, literal_column, table
+
+from database import db
+from models.search import term_frequency
+from utils.search_explain import no_explain
+from utils.sharded_search import sharded_engine
+from utils.sparse_search import sparse_engine
+
+
+class SearchBackend:
+    """
+    Interface of the text search backends. A backend is told about every saved service and scores search texts.
+    """
+    rankings = ('tfidf', 'bm25')  # rankings soportados, el primero es el de por defecto
+
+    def put(self, s):
+        """
+        Updates the backend with a service that has been saved
+        :param s: the service
+        """
+        raise NotImplementedError
+
+    def compact(self):
+        """
+        Purges what the backend keeps of services that are no longer live
+        :return: (number of term_frequency rows deleted, number of document_stats rows deleted)
+        """
+        return term_frequency.compact()
+
+    def rebuild(self):
+        """
+        Rebuilds what the backend keeps apart from the term_frequency index, called by reindex
+        """
+        pass
+
+    def score(self, q, ser_table, search_text, search_order, ranking, explain=no_explain, top_k=None):
+        """
+        Scores the services of a query for a search text
+        :param q: query with the filters to apply
+        :param ser_table: service table
+        :param search_text: text searched
+        :param search_order: if False the score only has to be good enough for the threshold cut of the results
+        :param ranking: one of self.rankings
+        :param explain: SearchExplain where the stages of the search are recorded
+        :param top_k: if given, the backend can return only the top_k best scored services
+        :return: dict service_id -> score (higher is better) of the matched services
+        """
+        raise NotImplementedError
+
+
+class TermFrequencyBackend(SearchBackend):
+    """
+    Backend that scores in Python with the in-memory index of the term_frequency table
+    """
+
+    def put(self, s):
+        term_frequency.put_service(s)
+
+    def score(self, q, ser_table, search_text, search_order, ranking, explain=no_explain, top_k=None):
+        with explain.stage('tokenization') as stage:
+            words, hashtags = term_frequency.search_text(search_text)
+            stage['rows'] = len(words) + len(hashtags)
+
+        if len(words) == 0 and len(hashtags) == 0:
+            return {service_id: 1 for service_id, in q.with_entities(ser_table.id)}
+
+        index = term_frequency.get_index()
+        with explain.stage('typo correction') as stage:
+            # Las palabras que no aparecen en el vocabulario se cambian por la más parecida (si la hay)
+            words = list(dict.fromkeys(index.correct(word) or word for word in words))
+            stage['words'] = words
+
+        with explain.stage('candidates', hashtags=list(hashtags)) as stage:
+            candidates = get_candidates(q, ser_table, index, words, hashtags)
+            stage['rows'] = len(candidates)
+
+        if len(words) == 0:
+            return {service_id: 1 for service_id in candidates}
+
+        n_shards = current_app.config.get('SEARCH_SHARDS', 0)
+        if n_shards > 1 and sharded_engine.available:
+            with explain.stage('scoring', engine='sharded', shards=n_shards) as stage:
+                scores = sharded_engine.score(index, words, candidates, search_order, ranking, n_shards, top_k)
+                stage['rows'] = len(scores)
+            return scores
+
+        if ranking == 'tfidf' and current_app.config.get('SEARCH_ENGINE') == 'sparse' and sparse_engine.available:
+            with explain.stage('scoring', engine='sparse') as stage:
+                scores = sparse_engine.score(index, words, candidates, search_order)
+                stage['rows'] = len(scores)
+            return scores
+
+        with explain.stage('scoring', engine='python') as stage:
+            scores = score_words(index, words, candidates, search_order, ranking, explain)
+            stage['rows'] = len(scores)
+        return scores
+
+
+class Fts5Backend(SearchBackend):
+    """
+    Backend that searches in an SQLite FTS5 virtual table with the title and description of the live services. Words
+    match as prefixes, all the hashtags must appear and the services are ranked by the bm25 function of FTS5 (the
+    only ranking it supports), so nothing is scored in Python. The table is created and filled on first use and
+    rebuilt by reindex.
+    """
+    table_name = 'service_fts'
+    rankings = ('bm25',)
+
+    def __init__(self):
+        self.created = set()  # urls de las bases de datos donde ya existe la tabla
+
+    def put(self, s):
+        # El índice de term_frequency se sigue usando para las sugerencias y la corrección de palabras
+        term_frequency.put_service(s)
+
+        self.create_table()
+        db.session.execute(text(f"DELETE FROM {self.table_name} WHERE rowid = :id"), {'id': s.id})
+        if s.state != 2:
+            db.session.execute(text(f"INSERT INTO {self.table_name}(rowid, title, description) "
+                                    f"VALUES (:id, :title, :description)"),
+                               {'id': s.id, 'title': s.title, 'description': s.description})
+        db.session.commit()
+
+    def compact(self):
+        self.create_table()
+        db.session.execute(text(f"DELETE FROM {self.table_name} "
+                                f"WHERE rowid NOT IN (SELECT id FROM services WHERE state != 2)"))
+        db.session.commit()
+        return super().compact()
+
+    def rebuild(self):
+        self.create_table()
+        db.session.execute(text(f"DELETE FROM {self.table_name}"))
+        db.session.execute(text(f"INSERT INTO {self.table_name}(rowid, title, description) "
+                                f"SELECT id, title, description FROM services WHERE state != 2"))
+        db.session.commit()
+
+    def score(self, q, ser_table, search_text, search_order, ranking, explain=no_explain, top_k=None):
+        with explain.stage('tokenization') as stage:
+            words, hashtags = term_frequency.search_text(search_text)
+            stage['rows'] = len(words) + len(hashtags)
+        candidates = q.with_entities(ser_table.id)
+
+        if len(words) == 0 and len(hashtags) == 0:
+            return {service_id: 1 for service_id, in candidates}
+
+        self.create_table()
+        match = ' AND '.join(fts_phrase(hashtag) for hashtag in hashtags)
+        if len(words) > 0:
+            any_word = '(' + ' OR '.join(fts_phrase(word) + '*' for word in words) + ')'
+            match = any_word if len(match) == 0 else match + ' AND ' + any_word
+
+        fts = table(self.table_name, column('rowid'))
+        fts_all = literal_column(self.table_name)
+        matches = db.session.query(fts.c.rowid, func.bm25(fts_all)).filter(fts_all.op('MATCH')(match)) \
+            .filter(fts.c.rowid.in_(candidates.statement))
+
+        with explain.stage('fts5 query', match=match) as stage:
+            # bm25 de FTS5 es negativo, cuanto más pequeño mejor
+            scores = {service_id: -rank for service_id, rank in matches}
+            stage['rows'] = len(scores)
+        return scores
+
+    def create_table(self):
+        """
+        Creates the FTS5 table, filled with the existing services, if it doesn't exist yet
+        """
+        url = str(db.engine.url)
+        if url in self.created:
+            return
+
+        exists = db.session.execute(text("SELECT 1 FROM sqlite_master WHERE name = :name"),
+                                    {'name': self.table_name}).first()
+        if not exists:
+            db.session.execute(text(f"CREATE VIRTUAL TABLE {self.table_name} "
+                                    f"USING fts5(title, description, tokenize=\"unicode61 tokenchars '#'\")"))
+            db.session.execute(text(f"INSERT INTO {self.table_name}(rowid, title, description) "
+                                    f"SELECT id, title, description FROM services WHERE state != 2"))
+            db.session.commit()
+        self.created.add(url)
+
+    def drop_table(self, connection):
+        """
+        Drops the FTS5 table, used when the services are dropped
+        :param connection: connection of the drop
+        """
+        if connection.dialect.name == 'sqlite':
+            connection.execute(text(f"DROP TABLE IF EXISTS {self.table_name}"))
+        self.created.discard(str(connection.engine.url))
+
+
+def fts_phrase(word):
+    """
+    :param word: a word of the search text
+    :return: the word quoted as an FTS5 string
+    """
+    return '"' + word.replace('"', '""') + '"'
+
+
+search_backends = {
+    'term_frequency': TermFrequencyBackend(),
+    'fts5': Fts5Backend(),
+}
+
+
+def get_search_backend():
+    """
+    :return: the search backend selected by the SEARCH_BACKEND config of the app
+    """
+    return search_backends[current_app.config.get('SEARCH_BACKEND', 'term_frequency')]
+
+
+def get_candidates(q, ser_table, index, words, hashtags, chunk_size=500, max_chunked=0.2):
+    """
+    Returns the services that can match a search: the ones that contain some of the words (or all the hashtags)
+    in the index and pass the filters. Only the matched ids are checked in the database, so a search costs the
+    matching rows and not the whole catalog
+    :param q: query with the filters to apply
+    :param ser_table: service table
+    :param index: the search index
+    :param words: query words
+    :param hashtags: list of hashtags that the services must contain
+    :param chunk_size: max number of ids per query
+    :param max_chunked: fraction of the indexed services over which the matched ids are checked with a single
+    query of the filters instead of sending them in chunks
+    :return: set of service ids
+    """
+    if len(hashtags) > 0:
+        matched = set(term_frequency.get_matches_all_words(hashtags))
+        if len(words) > 0 and len(matched) > 0:
+            matched &= index.matching_services(words)
+    else:
+        matched = index.matching_services(words)
+
+    if len(matched) == 0:
+        return matched
+    if len(matched) > max_chunked * len(index.indexed_services()):
+        # Si casi todo el catálogo coincide, enviar los ids en trozos cuesta más que una sola consulta
+        return {service_id for service_id, in q.with_entities(ser_table.id)} & matched
+    return filter_ids(q, ser_table, matched, chunk_size)
+
+
+def filter_ids(q, ser_table, service_ids, chunk_size=500):
+    """
+    Returns the given services that pass the filters of a query
+    :param q: query with the filters to apply
+    :param ser_table: service table
+    :param service_ids: iterable of service ids
+    :param chunk_size: max number of ids per query
+    :return: set of service ids
+    """
+    service_ids = sorted(service_ids)
+    passed = set()
+    for i in range(0, len(service_ids), chunk_size):
+        chunk = service_ids[i:i + chunk_size]
+        passed.update(service_id for service_id, in q.filter(ser_table.id.in_(chunk)).with_entities(ser_table.id))
+    return passed
+
+
+def score_words(index, words, candidates, search_order, ranking, explain=no_explain):
+    """
+    Scores the query words for the candidate services
+    :param index: the search index
+    :param words: query words
+    :param candidates: set with the ids of the services that can be returned
+    :param search_order: if False only the idf of the matched words is added
+    :param ranking: tfidf or bm25
+    :param explain: SearchExplain where the coincidences of each word are recorded
+    :return: dict service_id -> score of the matched services
+    """
+    scores = defaultdict(float)
+    total_documents = index.n_active
+
+    for word in words:
+
+        with explain.stage('coincidences', word=word) as stage:
+            coincidences_word = index.get_coincidences(word, candidates)
+            stage['rows'] = len(coincidences_word)
+
+        if len(coincidences_word) > 0:
+
+            partial_counts = defaultdict(float)
+
+            for matched_word, service_id, count in coincidences_word:
+                if ranking == 'bm25':
+                    partial_counts[service_id] += count * len(word) / len(matched_word)
+                else:
+                    partial_counts[service_id] += \
+                        count / index.documents[service_id].length * len(word) / len(matched_word)
+
+            if not search_order:
+                idf = log(1 + total_documents / len(coincidences_word))
+                for service_id in partial_counts:
+                    scores[service_id] += idf
+
+            elif ranking == 'bm25':
+                scores_bm25(scores, index, partial_counts)
+
+            else:
+                idf = log(1 + total_documents / len(coincidences_word))
+                for service_id, total_count in partial_counts.items():
+                    tf = log(1 + total_count)
+                    scores[service_id] += tf * idf
+
+    return scores
+
+
+def scores_bm25(scores, index, term_counts, k1=1.2, b=0.75):
+    """
+    Adds the BM25 score of a query word to the scores of the services. Only uses the postings and the
+    document stats kept by the index.
+    :param scores: dict service_id -> score to update
+    :param index: the search index
+    :param term_counts: dict service_id -> (weighted) number of occurrences of the word in the service
+    :param k1: term frequency saturation
+    :param b: length normalization
+    """
+    n_documents = index.n_active
+    n_matches = len(term_counts)
+    idf = log(1 + (n_documents - n_matches + 0.5) / (n_matches + 0.5))
+    average_terms = index.average_terms() or 1.0
+
+    for service_id, tf in term_counts.items():
+        length_norm = 1 - b + b * index.documents[service_id].n_terms / average_terms
+        scores[service_id] += idf * tf * (k1 + 1) / (tf + k1 * length_norm)
+
+
+# La tabla FTS5 no está en los modelos, así que se borra junto con term_frequency (p.e. en los tests)
+event.listen(term_frequency.__table__, "after_drop",
+             lambda target, connection, **kwargs: search_backends['fts5'].drop_table(connection))
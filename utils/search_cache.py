@@ -0,0 +1,137 @@
+from collections import OrderedDict
+from itertools import chain
+from threading import Lock
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+# Tablas cuyos cambios pueden cambiar el resultado de una búsqueda
+catalog_tables = {'services', 'reviews', 'users', 'contracted_services', 'term_frequency', 'document_stats'}
+
+
+class SearchCache:
+    """
+    LRU cache of serialized search responses limited by size in bytes. Every entry is tied to the catalog
+    version at the moment it was computed; any write that can change a search result bumps the version, so
+    stale entries are never served.
+    """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024):
+        self.lock = Lock()
+        self.max_bytes = max_bytes
+        self.version = 0
+        self.entries = OrderedDict()  # key -> (body, headers)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def bump_version(self):
+        """
+        Invalidates all the cached results. Must be called after any change in the catalog.
+        """
+        with self.lock:
+            self.version += 1
+            # Las entradas antiguas ya no se pueden servir, así que liberamos la memoria
+            self.entries.clear()
+            self.bytes = 0
+
+    def resize(self, max_bytes):
+        """
+        Changes the byte budget of the cache
+        :param max_bytes: max size of the cached bodies
+        """
+        with self.lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def key(self, *parts):
+        """
+        :param parts: normalized description of the request
+        :return: the key of the request for the current catalog version
+        """
+        return (self.version,) + parts
+
+    def get(self, key):
+        """
+        :param key: key returned by self.key
+        :return: (body, headers) or None if not cached
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, body, headers):
+        """
+        Caches a response
+        :param key: key returned by self.key
+        :param body: serialized body (bytes)
+        :param headers: dict with the headers of the response
+        """
+        with self.lock:
+            if key[0] != self.version or len(body) > self.max_bytes:
+                return
+
+            if key in self.entries:
+                self.bytes -= len(self.entries[key][0])
+
+            self.entries[key] = (body, headers)
+            self.bytes += len(body)
+            self._evict()
+
+    def stats(self):
+        """
+        :return: dict with the counters of the cache
+        """
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries), 'bytes': self.bytes,
+                    'max_bytes': self.max_bytes, 'version': self.version}
+
+    def _evict(self):
+        while self.bytes > self.max_bytes:
+            _, (body, _) = self.entries.popitem(last=False)
+            self.bytes -= len(body)
+
+
+search_cache = SearchCache()
+
+
+def _table_name(obj):
+    return getattr(getattr(obj, '__table__', None), 'name', None)
+
+
+@event.listens_for(Session, "after_flush")
+def _mark_catalog_changes(session, flush_context):
+    """
+    Remembers that the transaction wrote rows that can change a search result
+    """
+    changed = chain(session.new, session.deleted, (obj for obj in session.dirty if session.is_modified(obj)))
+    if any(_table_name(obj) in catalog_tables for obj in changed):
+        session.info['catalog_changed'] = True
+
+
+@event.listens_for(Session, "after_bulk_update")
+@event.listens_for(Session, "after_bulk_delete")
+def _mark_catalog_bulk_changes(context):
+    if context.mapper.local_table.name in catalog_tables:
+        context.session.info['catalog_changed'] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _bump_catalog_version(session):
+    """
+    Invalidates the cached searches once the changes of the catalog are committed, so every write path (also
+    the ones done through relationship cascades) bumps the version
+    """
+    if session.info.pop('catalog_changed', False):
+        search_cache.bump_version()
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_catalog_changes(session):
+    session.info.pop('catalog_changed', None)
@@ -0,0 +1,74 @@
+from contextlib import contextmanager, nullcontext
+from threading import get_ident
+from time import perf_counter
+
+from sqlalchemy import event
+
+
+class SearchExplain:
+    """
+    Collects the time and the number of rows of each stage of a search, and the SQL statements executed
+    """
+    enabled = True
+
+    def __init__(self):
+        self.start = perf_counter()
+        self.stages = []
+        self.statements = []
+
+    @contextmanager
+    def stage(self, name, **details):
+        """
+        Times a stage. The stage is recorded when it ends, so stages run inside another one come first
+        :param name: name of the stage
+        :param details: extra information of the stage (p.e. the word looked up)
+        :return: context manager giving a dict where the rows of the stage can be set
+        """
+        info = {'stage': name, **details}
+        start = perf_counter()
+        try:
+            yield info
+        finally:
+            info['ms'] = round((perf_counter() - start) * 1000, 3)
+            self.stages.append(info)
+
+    @contextmanager
+    def capture_sql(self, engine):
+        """
+        Records the statements executed by this thread on an engine
+        :param engine: the database engine
+        """
+        thread = get_ident()
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if get_ident() == thread:
+                self.statements.append(statement)
+
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            yield
+        finally:
+            event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+    def to_dict(self):
+        return {
+            'total_ms': round((perf_counter() - self.start) * 1000, 3),
+            'stages': self.stages,
+            'sql': self.statements
+        }
+
+
+class NoExplain:
+    """
+    Does nothing, used when the search is not explained
+    """
+    enabled = False
+
+    def stage(self, name, **details):
+        return nullcontext({})
+
+    def capture_sql(self, engine):
+        return nullcontext()
+
+
+no_explain = NoExplain()
@@ -0,0 +1,97 @@
+from collections import Counter
+from math import isnan
+
+from sqlalchemy.sql import alias
+
+from models.search import term_frequency
+from models.service import Service
+
+price_edges = (0, 10, 25, 50, 100, 250, 500, 1000)
+rating_edges = (0, 1, 2, 3, 4)
+
+
+class SearchFacets:
+    """
+    Counts of the results of a search used to build the filters of the UI: price histogram, rating of the master
+    service, most common hashtags and if the service requires a place. All of them are computed from a single
+    query with the price, rating and requiresPlace of the results, the hashtags come from the in-memory index.
+    """
+
+    def __init__(self, n_hashtags=10):
+        self.n_hashtags = n_hashtags
+        self.prices = Counter()  # índice del intervalo -> número de servicios
+        self.ratings = Counter()
+        self.unrated = 0
+        self.requires_place = Counter()
+        self.hashtags = Counter()
+        self.total = 0
+
+    def collect_query(self, q, ser_table):
+        """
+        Adds all the services of a query
+        :param q: query with the filters to apply
+        :param ser_table: service table
+        """
+        self._add(facet_query(q, ser_table))
+
+    def collect_ids(self, ser_table, service_ids, chunk_size=500):
+        """
+        Adds the services with the given ids
+        :param ser_table: service table
+        :param service_ids: ids of the services
+        :param chunk_size: max number of ids per query
+        """
+        service_ids = list(service_ids)
+        for i in range(0, len(service_ids), chunk_size):
+            chunk = service_ids[i:i + chunk_size]
+            self._add(facet_query(ser_table.query.filter(ser_table.id.in_(chunk)), ser_table))
+
+    def to_dict(self):
+        return {
+            'total': self.total,
+            'price': [{'min': low, 'max': high, 'count': self.prices[i]}
+                      for i, (low, high) in enumerate(zip(price_edges, price_edges[1:] + (None,)))],
+            'rating': [{'min': low, 'max': low + 1, 'count': self.ratings[i]} for i, low in enumerate(rating_edges)] +
+                      [{'min': None, 'max': None, 'count': self.unrated}],
+            'hashtags': [{'hashtag': hashtag, 'count': count}
+                         for hashtag, count in self.hashtags.most_common(self.n_hashtags)],
+            'requiresPlace': {'true': self.requires_place[True], 'false': self.requires_place[False]}
+        }
+
+    def _add(self, rows):
+        doc_words = term_frequency.get_index().doc_words
+
+        for service_id, price, grade, requires_place in rows:
+            self.total += 1
+            self.prices[bucket(price_edges, float(price))] += 1
+
+            if grade is None or isnan(grade):
+                self.unrated += 1
+            else:
+                self.ratings[bucket(rating_edges, grade)] += 1
+
+            self.requires_place[bool(requires_place)] += 1
+            self.hashtags.update(word for word in doc_words.get(service_id, ()) if word.startswith('#'))
+
+
+def facet_query(q, ser_table):
+    """
+    :param q: query with the services
+    :param ser_table: service table
+    :return: query with the id, price, rating of the master service and requiresPlace of the services
+    """
+    master = alias(Service)
+    return q.outerjoin(master, ser_table.masterID == master.c.id) \
+        .with_entities(ser_table.id, ser_table.price, master.c.service_grade, ser_table.requiresPlace)
+
+
+def bucket(edges, value):
+    """
+    :param edges: sorted lower edges of the intervals, the last interval is open
+    :param value: value to classify
+    :return: index of the interval of the value (values under the first edge go to the first interval)
+    """
+    i = 0
+    while i + 1 < len(edges) and value >= edges[i + 1]:
+        i += 1
+    return i
@@ -0,0 +1,571 @@
+from array import array
+from bisect import bisect_left, insort
+from collections import namedtuple
+from heapq import nsmallest
+from threading import RLock
+
+# Estadísticas de un servicio indexado: longitud del texto, número de tokens y estado del servicio
+Document = namedtuple('Document', ['length', 'n_terms', 'state'])
+
+
+class NgramIndex:
+    """
+    Index of the vocabulary by bigrams and trigrams. Returns the words that contain a given substring
+    intersecting the word sets of its grams instead of scanning the whole vocabulary.
+    """
+
+    def __init__(self):
+        self.words = set()
+        self.grams = {}  # gram -> set of words containing it
+
+    def add(self, word):
+        """
+        Adds a word to the vocabulary
+        :param word: the word
+        """
+        if word in self.words:
+            return
+
+        self.words.add(word)
+        for gram in self._grams(word):
+            self.grams.setdefault(gram, set()).add(word)
+
+    def remove(self, word):
+        """
+        Removes a word from the vocabulary
+        :param word: the word
+        """
+        if word not in self.words:
+            return
+
+        self.words.remove(word)
+        for gram in self._grams(word):
+            words = self.grams[gram]
+            words.discard(word)
+            if len(words) == 0:
+                del self.grams[gram]
+
+    def search(self, substring):
+        """
+        Returns the words of the vocabulary that contain the substring
+        :param substring: searched text
+        :return: sorted list of words
+        """
+        if len(substring) < 2:
+            return sorted(w for w in self.words if substring in w)
+
+        n = 3 if len(substring) >= 3 else 2
+        word_sets = []
+        for i in range(len(substring) - n + 1):
+            words = self.grams.get(substring[i:i + n])
+            if not words:
+                return []
+            word_sets.append(words)
+
+        # Empezamos por el conjunto más pequeño para que la intersección sea lo más barata posible
+        word_sets.sort(key=len)
+        candidates = set(word_sets[0])
+        for words in word_sets[1:]:
+            candidates &= words
+            if not candidates:
+                return []
+
+        # Tener todos los trigramas no garantiza que aparezcan seguidos
+        if len(substring) > n:
+            return sorted(w for w in candidates if substring in w)
+        return sorted(candidates)
+
+    @staticmethod
+    def _grams(word):
+        for n in (2, 3):
+            for i in range(len(word) - n + 1):
+                yield word[i:i + n]
+
+
+class PrefixTrie:
+    """
+    Trie over the vocabulary used to complete prefixes. Every node is a dict from characters to nodes, the
+    words end in a node with the key ''. The most frequent words of the prefixes asked are cached and kept up to
+    date when the frequencies change, so completing a short prefix doesn't walk most of the vocabulary.
+    """
+
+    def __init__(self, top_size=50):
+        self.root = {}
+        self.top_size = top_size
+        self.tops = {}  # prefijo -> lista ordenada de (-frecuencia, palabra) con las top_size más frecuentes
+
+    def add(self, word):
+        """
+        Adds a word to the trie
+        :param word: the word
+        """
+        node = self.root
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = word
+
+    def remove(self, word):
+        """
+        Removes a word from the trie, pruning the branches that become empty
+        :param word: the word
+        """
+        path = [self.root]
+        for char in word:
+            node = path[-1].get(char)
+            if node is None:
+                return
+            path.append(node)
+
+        path[-1].pop('', None)
+        for depth in range(len(word), 0, -1):
+            if path[depth]:
+                break
+            path[depth - 1].pop(word[depth - 1])
+
+    def complete(self, prefix):
+        """
+        :param prefix: beginning of the words
+        :return: generator with the words that start with the prefix
+        """
+        node = self.root
+        for char in prefix:
+            node = node.get(char)
+            if node is None:
+                return
+
+        pending = [node]
+        while pending:
+            node = pending.pop()
+            for char, child in node.items():
+                if char == '':
+                    yield child
+                else:
+                    pending.append(child)
+
+    def top(self, prefix, n, frequency):
+        """
+        Returns the most frequent words that start with a prefix. The first time a prefix is asked its subtree is
+        walked, then the result is cached
+        :param prefix: beginning of the words
+        :param n: max number of words returned
+        :param frequency: function that returns the frequency of a word of the trie
+        :return: list of words sorted by frequency (and alphabetically on ties)
+        """
+        if n > self.top_size:
+            return [word for _, word in nsmallest(n, ((-frequency(w), w) for w in self.complete(prefix)))]
+
+        top = self.tops.get(prefix)
+        if top is None:
+            top = nsmallest(self.top_size, ((-frequency(w), w) for w in self.complete(prefix)))
+            if len(top) == 0:
+                return []
+            self.tops[prefix] = top
+        return [word for _, word in top[:n]]
+
+    def update(self, word, old_frequency, frequency):
+        """
+        Updates the cached lists of the prefixes of a word after a change of its frequency
+        :param word: the word
+        :param old_frequency: previous frequency, 0 if the word is new
+        :param frequency: new frequency, 0 if the word has been removed
+        """
+        if not self.tops:
+            return
+
+        old_key, key = (-old_frequency, word), (-frequency, word)
+        for i in range(1, len(word) + 1):
+            prefix = word[:i]
+            top = self.tops.get(prefix)
+            if top is None:
+                continue
+
+            # La lista tiene las top_size palabras más frecuentes del prefijo, o todas si no llegan
+            full = len(top) == self.top_size
+            last = top[-1]
+            listed = old_frequency > 0 and old_key <= last
+            if listed:
+                del top[bisect_left(top, old_key)]
+
+            if frequency > 0 and (not full or key < last):
+                insort(top, key)
+                if len(top) > self.top_size:
+                    top.pop()
+            elif (listed and full) or len(top) == 0:
+                # No se sabe cuál es la siguiente palabra, se vuelve a calcular cuando se pida
+                del self.tops[prefix]
+
+
+class DeletionIndex:
+    """
+    SymSpell-like index to correct typos. Maps every string obtained deleting up to max_distance characters from
+    the beginning (prefix_length characters) of a word to the words that generated it. Two words within the edit
+    distance share a deletion, so the candidates of a misspelled word are found with hash probes.
+    """
+
+    def __init__(self, max_distance=2, prefix_length=7):
+        self.max_distance = max_distance
+        self.prefix_length = prefix_length
+        self.deletions = {}  # deletion -> set of words
+
+    def add(self, word):
+        """
+        Adds a word to the index
+        :param word: the word
+        """
+        for deletion in self._deletions(word):
+            self.deletions.setdefault(deletion, set()).add(word)
+
+    def remove(self, word):
+        """
+        Removes a word from the index
+        :param word: the word
+        """
+        for deletion in self._deletions(word):
+            words = self.deletions.get(deletion)
+            if words is not None:
+                words.discard(word)
+                if len(words) == 0:
+                    del self.deletions[deletion]
+
+    def lookup(self, word, max_distance):
+        """
+        Returns the words of the index closest to the given one
+        :param word: the (misspelled) word
+        :param max_distance: max edit distance allowed, at most self.max_distance
+        :return: (distance, list of words at that distance). The list is empty if there is no word close enough
+        """
+        best_distance, best_words = max_distance + 1, []
+        seen = set()
+
+        for deletion in self._deletions(word, max_distance):
+            for candidate in self.deletions.get(deletion, ()):
+                if candidate in seen:
+                    continue
+                seen.add(candidate)
+
+                distance = edit_distance(word, candidate, best_distance)
+                if distance > max_distance:
+                    continue
+                if distance < best_distance:
+                    best_distance, best_words = distance, [candidate]
+                elif distance == best_distance:
+                    best_words.append(candidate)
+
+        return best_distance, best_words
+
+    def _deletions(self, word, max_distance=None):
+        max_distance = self.max_distance if max_distance is None else max_distance
+        level = {word[:self.prefix_length]}
+        deletions = set(level)
+
+        for _ in range(max_distance):
+            level = {w[:i] + w[i + 1:] for w in level for i in range(len(w))} - deletions
+            deletions |= level
+
+        return deletions
+
+
+def edit_distance(a, b, max_distance):
+    """
+    Damerau-Levenshtein distance (optimal string alignment) between two words
+    :param a: first word
+    :param b: second word
+    :param max_distance: distances over it are not computed exactly
+    :return: the distance, or max_distance + 1 if it is greater than max_distance
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+
+    previous_previous = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous_previous[j - 2] + 1)
+
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous_previous, previous = previous, current
+
+    return min(previous[-1], max_distance + 1)
+
+
+class InvertedIndex:
+    """
+    Process resident copy of the term_frequency table. For every word it keeps the ids of the services that
+    contain it, packed in sorted arrays together with the number of occurrences, and for every service its
+    document stats. It lets the search score a query without going to the database once per word.
+    """
+
+    def __init__(self):
+        self.lock = RLock()
+        self.listeners = []
+        self.clear()
+
+    def add_listener(self, listener):
+        """
+        Registers an object that keeps derived structures up to date. It must implement put(service_id, counts),
+        remove(service_id) and clear(), that are called with the index locked.
+        :param listener: the listener
+        """
+        with self.lock:
+            self.listeners.append(listener)
+
+    def clear(self):
+        """
+        Empties the index and marks it as not loaded, so that it is rebuilt from the database on next use
+        """
+        with self.lock:
+            for listener in self.listeners:
+                listener.clear()
+
+            self.loaded = False
+            self.postings = {}  # word -> (array of service ids, array of counts), sorted by service id
+            self.documents = {}  # service id -> Document
+            self.doc_words = {}  # service id -> words indexed for that service
+            self.live = set()  # ids de los servicios con alguna palabra indexada
+            self.vocabulary = NgramIndex()
+            self.prefixes = PrefixTrie()
+            self.typos = DeletionIndex()
+
+            # Estadísticas del corpus, se mantienen incrementalmente
+            self.n_documents = 0
+            self.n_active = 0
+            self.total_terms = 0
+
+    def build(self, rows, documents):
+        """
+        Replaces the content of the index
+        :param rows: iterable of (word, service_id, count)
+        :param documents: iterable of (service_id, text length, number of tokens, service state)
+        """
+        with self.lock:
+            self.clear()
+
+            for word, service_id, count in rows:
+                self._add_posting(word, service_id, count)
+                self.doc_words.setdefault(service_id, []).append(word)
+            self.live.update(self.doc_words)
+
+            for service_id, length, n_terms, state in documents:
+                self._add_document(service_id, Document(length, n_terms, state))
+
+            self.loaded = True
+
+    def put(self, service_id, counts, length, state):
+        """
+        Indexes (or reindexes) a service
+        :param service_id: id of the service
+        :param counts: list of (word, count) of the service
+        :param length: length of the text of the service
+        :param state: state of the service
+        """
+        with self.lock:
+            self._remove(service_id)
+
+            words = []
+            for word, count in counts:
+                self._add_posting(word, service_id, count)
+                words.append(word)
+
+            self.doc_words[service_id] = words
+            if words:
+                self.live.add(service_id)
+            self._add_document(service_id, Document(length, sum(count for _, count in counts), state))
+
+            for listener in self.listeners:
+                listener.put(service_id, counts)
+
+    def remove(self, service_id):
+        """
+        Removes all the postings of a service
+        :param service_id: id of the service
+        """
+        with self.lock:
+            self._remove(service_id)
+
+            for listener in self.listeners:
+                listener.remove(service_id)
+
+    def average_terms(self):
+        """
+        :return: average number of tokens of the indexed services
+        """
+        return self.total_terms / self.n_documents if self.n_documents else 0.0
+
+    def get_coincidences(self, word, candidates):
+        """
+        Returns the postings of all the words of the vocabulary that contain the given one
+        :param word: searched word
+        :param candidates: set with the ids of the services that can be returned
+        :return: list of (matched word, service_id, count)
+        """
+        with self.lock:
+            coincidences = []
+            for matched_word in self.matching_words(word):
+                ids, counts = self.postings[matched_word]
+                coincidences.extend((matched_word, service_id, count)
+                                    for service_id, count in zip(ids, counts) if service_id in candidates)
+            return coincidences
+
+    def match_all(self, words):
+        """
+        Returns the services that contain all the given words (exact match)
+        :param words: list of words
+        :return: sorted list of service ids
+        """
+        with self.lock:
+            id_lists = []
+            for word in words:
+                if word not in self.postings:
+                    return []
+                id_lists.append(self.postings[word][0])
+            return intersect_sorted(id_lists)
+
+    def matching_services(self, words):
+        """
+        Returns the services with a posting of some word of the vocabulary that contains one of the given words
+        :param words: searched words
+        :return: set of service ids
+        """
+        with self.lock:
+            service_ids = set()
+            for word in words:
+                for matched_word in self.matching_words(word):
+                    service_ids.update(self.postings[matched_word][0])
+            return service_ids
+
+    def indexed_services(self):
+        """
+        :return: set with the ids of the services with at least one posting. It is kept up to date by the index,
+        so it must not be modified
+        """
+        with self.lock:
+            return self.live
+
+    def suggest(self, prefix, n):
+        """
+        Completes a prefix with the words of the vocabulary that appear in more services
+        :param prefix: beginning of the words
+        :param n: max number of words returned
+        :return: list of words sorted by number of services (and alphabetically on ties)
+        """
+        with self.lock:
+            return self.prefixes.top(prefix, n, lambda w: len(self.postings[w][0]))
+
+    def correct(self, word):
+        """
+        Corrects a word that doesn't match any word of the vocabulary
+        :param word: searched word
+        :return: the word itself if it matches the vocabulary, the closest word of the vocabulary (the one in more
+        services on ties) if it is a typo, or None if there is nothing close
+        """
+        with self.lock:
+            if self.vocabulary.search(word):
+                return word
+
+            # Con palabras cortas una distancia de 2 lo cambia casi todo
+            _, corrections = self.typos.lookup(word, 1 if len(word) <= 4 else 2)
+            if len(corrections) == 0:
+                return None
+            return min(corrections, key=lambda w: (-len(self.postings[w][0]), w))
+
+    def matching_words(self, word):
+        """
+        Returns the words of the vocabulary that contain the given one
+        :param word: searched word
+        :return: list of words
+        """
+        with self.lock:
+            return self.vocabulary.search(word)
+
+    def _remove(self, service_id):
+        self.live.discard(service_id)
+        for word in self.doc_words.pop(service_id, ()):
+            self._remove_posting(word, service_id)
+
+        document = self.documents.pop(service_id, None)
+        if document is not None:
+            self.n_documents -= 1
+            self.n_active -= document.state == 0
+            self.total_terms -= document.n_terms
+
+    def _add_document(self, service_id, document):
+        self.documents[service_id] = document
+        self.n_documents += 1
+        self.n_active += document.state == 0
+        self.total_terms += document.n_terms
+
+    def _add_posting(self, word, service_id, count):
+        if word not in self.postings:
+            self.postings[word] = (array('l'), array('l'))
+            self.vocabulary.add(word)
+            self.prefixes.add(word)
+            if word[0] != '#':
+                self.typos.add(word)
+
+        ids, counts = self.postings[word]
+        position = bisect_left(ids, service_id)
+        ids.insert(position, service_id)
+        counts.insert(position, count)
+        self.prefixes.update(word, len(ids) - 1, len(ids))
+
+    def _remove_posting(self, word, service_id):
+        ids, counts = self.postings[word]
+        position = bisect_left(ids, service_id)
+
+        if position < len(ids) and ids[position] == service_id:
+            del ids[position]
+            del counts[position]
+            self.prefixes.update(word, len(ids) + 1, len(ids))
+
+        if len(ids) == 0:
+            del self.postings[word]
+            self.vocabulary.remove(word)
+            self.prefixes.remove(word)
+            if word[0] != '#':
+                self.typos.remove(word)
+
+
+def intersect_sorted(id_lists):
+    """
+    Intersects sorted lists of ids. Starts by the shortest list and looks up its ids in the others with a
+    galloping binary search, so the cost depends on the smallest list and not on the longest ones.
+    :param id_lists: list of sorted sequences of ids
+    :return: sorted list with the ids present in all the lists
+    """
+    if len(id_lists) == 0:
+        return []
+
+    id_lists = sorted(id_lists, key=len)
+    result = list(id_lists[0])
+
+    for ids in id_lists[1:]:
+        intersection = []
+        low = 0
+        for service_id in result:
+            # Búsqueda exponencial a partir de la última posición encontrada
+            step = 1
+            high = low
+            while high < len(ids) and ids[high] < service_id:
+                low = high
+                high += step
+                step *= 2
+            low = bisect_left(ids, service_id, low, min(high + 1, len(ids)))
+
+            if low == len(ids):
+                break
+            if ids[low] == service_id:
+                intersection.append(service_id)
+
+        result = intersection
+        if not result:
+            break
+
+    return result
+
+
+search_index = InvertedIndex()
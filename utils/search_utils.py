@@ -1,16 +1,17 @@
-from collections import defaultdict
-from math import log
+from datetime import date
+from heapq import nlargest
 
 from flask import g
-from sqlalchemy import or_, asc, desc, func
+from sqlalchemy import or_, asc, desc, tuple_
 from sqlalchemy.sql import alias
 from sqlalchemy.orm import Query
 from werkzeug.exceptions import NotFound, BadRequest
 
-from models.contracted_service import ContractedService
-from models.search import term_frequency
 from models.service import Service
 from models.user import User
+from utils.search_backends import get_search_backend
+from utils.search_explain import no_explain
+
 
 
 def filter_query(q: Query, ser_table: Service, filters):
@@ -26,15 +27,11 @@ def filter_query(q: Query, ser_table: Service, filters):
 
         elif filter_name == 'popularity':
 
-            brothers = alias(Service)
-
-            q_contracted = ContractedService.query.filter(ContractedService.state == 2).subquery()
-
-            q = q.outerjoin(brothers, ser_table.masterID == brothers.c.masterID). \
-                outerjoin(q_contracted, q_contracted.c.service_id == brothers.c.id).group_by(ser_table.id)
-
-            filter_quantity = func.count(q_contracted.c.id)
-            query_filtering = lambda qu: qu.having
+            # Los contratos completados de todas las versiones se cuentan en el servicio maestro
+            master = alias(Service)
+            q = q.join(master, ser_table.masterID == master.c.id)
+            filter_quantity = master.c.completed_contracts
+            query_filtering = lambda qu: qu.filter
 
         elif filter_name == 'rating':
 
@@ -56,44 +53,7 @@ def filter_query(q: Query, ser_table: Service, filters):
 
 
 def sort_query_services(q, ser_table, passed_arguments):
-    if 'by' not in passed_arguments:
-        raise BadRequest('Specify what to sort by!')
-
-    if passed_arguments['by'] == 'price':
-        sort_criterion = ser_table.price
-
-    elif passed_arguments['by'] == 'creation_date':
-        sort_criterion = ser_table.created_at
-
-    elif passed_arguments['by'] == 'rating':
-
-        master = alias(Service)
-        q = q.join(master, ser_table.masterID == master.c.id)
-        sort_criterion = master.c.service_grade
-
-    elif passed_arguments['by'] == 'popularity':
-
-        brothers = alias(Service)
-
-        q_contracted = ContractedService.query.filter(ContractedService.state == 2).subquery()
-
-        q = q.outerjoin(brothers, ser_table.masterID == brothers.c.masterID).\
-            outerjoin(q_contracted, q_contracted.c.service_id == brothers.c.id).group_by(ser_table.id)
-
-        sort_criterion = func.count(q_contracted.c.id)
-
-
-    else:
-        raise NotImplementedError('This sorting method is not supported!')
-
-    if 'reverse' in passed_arguments:
-        reverse = passed_arguments['reverse']
-
-        if reverse not in [True, False]:
-            raise BadRequest('reverse parameter must be True or False!')
-
-    else:
-        reverse = False
+    q, sort_criterion, reverse = get_sort_criterion(q, ser_table, passed_arguments)
 
     if reverse:
         return q.order_by(desc(sort_criterion))
@@ -101,28 +61,34 @@ def sort_query_services(q, ser_table, passed_arguments):
         return q.order_by(asc(sort_criterion))
 
 
-def sort_services(list_to_sort, passed_arguments):
+def get_sort_criterion(q, ser_table, passed_arguments):
+    """
+    Builds the SQL expression to sort services by
+    :param q: query with the services
+    :param ser_table: service table
+    :param passed_arguments: sort of the request (by and reverse)
+    :return: (query with the joins needed by the criterion, criterion, reverse)
+    """
     if 'by' not in passed_arguments:
         raise BadRequest('Specify what to sort by!')
 
     if passed_arguments['by'] == 'price':
-        def sort_criterion(s: Service):
-            return s.price
+        sort_criterion = ser_table.price
 
     elif passed_arguments['by'] == 'creation_date':
-        def sort_criterion(s: Service):
-            return s.created_at
+        sort_criterion = ser_table.created_at
 
     elif passed_arguments['by'] == 'rating':
-        def sort_criterion(s: Service):
-            return s.master_service.service_grade
+
+        master = alias(Service)
+        q = q.join(master, ser_table.masterID == master.c.id)
+        sort_criterion = master.c.service_grade
 
     elif passed_arguments['by'] == 'popularity':
 
-        def sort_criterion(s: Service):
-            return sum(
-                (len([c for c in b.contracts if c.state == 2]) for b in s.master_service.child_services)
-            )
+        master = alias(Service)
+        q = q.join(master, ser_table.masterID == master.c.id)
+        sort_criterion = master.c.completed_contracts
 
     else:
         raise NotImplementedError('This sorting method is not supported!')
@@ -136,60 +102,218 @@ def sort_services(list_to_sort, passed_arguments):
     else:
         reverse = False
 
-    list_to_sort.sort(key=sort_criterion, reverse=reverse)
-
-
-def get_matches_text(q, ser_table, search_text, search_order, threshold=0.9):
-    coincidences_queries, hashtag_query = term_frequency.search_text(search_text)
-
-    if len(coincidences_queries) == 0:
-        scores = {c: 1 for c in q.join(hashtag_query.subquery()).all()}
-
-    else:
-
-        scores = defaultdict(float)
-        total_documents = Service.get_count()
-
-        for word, coincidences_query in coincidences_queries:
-
-            merged_query = coincidences_query.join(q.join(hashtag_query.subquery()).subquery())
-            coincidences_word = merged_query.all()
-
-            if len(coincidences_word) > 0:
-
-                idf = log(1 + total_documents / len(coincidences_word))
-                partial_counts = defaultdict(float)
-
-                for coincidence in coincidences_word:
-                    count = int.from_bytes(coincidence.count, "little")
-                    partial_counts[coincidence.service] += \
-                        count / (len(coincidence.service.description) + len(coincidence.service.title)) * \
-                        len(word) / len(coincidence.word)
-
-                for service, total_count in partial_counts.items():
-
-                    if search_order:
-                        tf = log(1 + total_count)
-                        scores[service] += tf * idf
-
-                    else:
-                        scores[service] += idf
-
-    all_scored = sorted(scores.items(), key=lambda x: x[1], reverse=True)
+    return q, sort_criterion, reverse
+
+
+def sort_matches(ser_table, service_ids, passed_arguments, chunk_size=500):
+    """
+    Sorts the ids of matched services. The sort key of all of them is read with one SQL query (per chunk of ids)
+    instead of loading the relationships of every service. The sort is stable, so services with the same key keep
+    the order of service_ids
+    :param ser_table: service table
+    :param service_ids: ids ordered by relevance
+    :param passed_arguments: sort of the request (by and reverse)
+    :param chunk_size: max number of ids per query
+    :return: sorted list of ids
+    """
+    q, sort_criterion, reverse = get_sort_criterion(ser_table.query, ser_table, passed_arguments)
+
+    keys = {}
+    for i in range(0, len(service_ids), chunk_size):
+        chunk = service_ids[i:i + chunk_size]
+        keys.update(q.filter(ser_table.id.in_(chunk)).with_entities(ser_table.id, sort_criterion))
+
+    # Los NULL van primero, como en el ORDER BY de SQLite
+    return sorted((service_id for service_id in service_ids if service_id in keys),
+                  key=lambda service_id: (keys[service_id] is not None, keys[service_id]), reverse=reverse)
+
+
+def get_page(info):
+    """
+    Reads the pagination parameters of a request
+    :param info: dict with the parameters (json body or query string)
+    :return: (limit, offset). limit is None when the results are not paginated
+    """
+    try:
+        limit = None if info.get('limit') is None else int(info['limit'])
+        offset = int(info.get('cursor') or 0)
+    except (TypeError, ValueError):
+        raise BadRequest('limit and cursor must be integers!')
+
+    if (limit is not None and limit <= 0) or offset < 0:
+        raise BadRequest('limit must be positive and cursor can not be negative!')
+
+    return limit, offset
+
+
+def paginate(window, limit, offset):
+    """
+    Cuts a page of results
+    :param window: results starting at offset. If limit is given it must contain up to limit + 1 results, the
+    extra one tells if there is a next page
+    :param limit: page size, None if not paginated
+    :param offset: position of the first result of the page
+    :return: (page, next_cursor). next_cursor is None in the last page
+    """
+    if limit is None or len(window) <= limit:
+        return window, None
+    return window[:limit], offset + limit
+
+
+def get_feed_page(info, default_limit=20, max_limit=100):
+    """
+    Reads the pagination parameters of the feed. The cursor is the creation date and the id of the last service
+    of the previous page, as 'YYYY-MM-DD_id'
+    :param info: dict with the parameters (query string)
+    :param default_limit: page size when the request has no limit
+    :param max_limit: maximum page size
+    :return: (limit, (created_at, id) or None for the first page)
+    """
+    try:
+        limit = int(info.get('limit') or default_limit)
+    except (TypeError, ValueError):
+        raise BadRequest('limit must be an integer!')
+    if not 0 < limit <= max_limit:
+        raise BadRequest('limit must be between 1 and ' + str(max_limit) + '!')
+
+    cursor = info.get('cursor')
+    if not cursor:
+        return limit, None
+    try:
+        created_at, service_id = cursor.split('_')
+        return limit, (date.fromisoformat(created_at), int(service_id))
+    except ValueError:
+        raise BadRequest('invalid cursor!')
+
+
+def feed_query(q, ser_table, limit, after=None):
+    """
+    Returns the newest services of a query with keyset pagination: the services are sorted by creation date and id,
+    newest first, and the page starts after the last service of the previous one, so no rows are skipped with
+    OFFSET. Uses the (state, created_at, id) index of the services
+    :param q: query with the services
+    :param ser_table: service table
+    :param limit: page size
+    :param after: (created_at, id) of the last service of the previous page or None
+    :return: (page, cursor of the next page or None)
+    """
+    q = q.filter(ser_table.created_at.isnot(None))
+    if after is not None:
+        q = q.filter(tuple_(ser_table.created_at, ser_table.id) < after)
+    window = q.order_by(ser_table.created_at.desc(), ser_table.id.desc()).limit(limit + 1).all()
+
+    if len(window) <= limit:
+        return window, None
+    last = window[limit - 1]
+    return window[:limit], last.created_at.isoformat() + '_' + str(last.id)
+
+
+def get_matches_text(q, ser_table, search_text, search_order, threshold=0.9, ranking=None, limit=None, offset=0,
+                     explain=no_explain, facets=None, stream=False, options=()):
+    """
+    Returns the services matching a search text, see get_matching_ids
+    :param stream: if True the services are loaded in batches while they are iterated, only when not paginated
+    :param options: loader options of the query of the services (p.e. load_only)
+    :return: list (or iterator) of services
+    """
+    service_ids = get_matching_ids(q, ser_table, search_text, search_order, threshold, ranking, limit, offset, explain,
+                                   facets)
+    if stream:
+        return iter_services(ser_table, service_ids, options=options)
+
+    with explain.stage('load services') as stage:
+        services = load_services(ser_table, service_ids, options=options)
+        stage['rows'] = len(services)
+    return services
+
+
+def get_matching_ids(q, ser_table, search_text, search_order, threshold=0.9, ranking=None, limit=None, offset=0,
+                     explain=no_explain, facets=None):
+    """
+    Returns the ids of the services matching a search text
+    :param q: query with the filters to apply
+    :param ser_table: service table
+    :param search_text: text searched
+    :param search_order: if True the services are ranked by relevance, else all the services with a score
+    over the threshold are returned
+    :param threshold: minimum score, relative to the best one, when search_order is False
+    :param ranking: one of the rankings of the search backend (tfidf or bm25), None for its default
+    :param limit: page size. When given with search_order only the services of the page (and one more, to know
+    if there is a next page) are selected with a heap
+    :param offset: position of the first service of the page when limit is given
+    :param explain: SearchExplain where the stages of the search are recorded
+    :param facets: SearchFacets where all the matched services (not only the page) are added, None if not needed
+    :return: ordered list of service ids
+    """
+    backend = get_search_backend()
+    if ranking is None:
+        ranking = backend.rankings[0]
+    if ranking not in backend.rankings:
+        raise BadRequest('ranking must be one of ' + ', '.join(backend.rankings))
+
+    # Con una página (y sin facetas, que cuentan todos los resultados) solo hacen falta los mejores
+    top_k = offset + limit + 1 if search_order and limit is not None and facets is None else None
+    scores = backend.score(q, ser_table, search_text, search_order, ranking, explain, top_k)
 
     if not search_order:
 
-        if len(all_scored) == 0:
-            return []
+        with explain.stage('threshold cut') as stage:
+            all_scored = sorted(scores.items(), key=lambda x: x[1], reverse=True)
+
+            n = 0
+            while n < len(all_scored) and all_scored[n][1] >= all_scored[0][1] * threshold:
+                n += 1
 
-        n = 0
-        while n < len(all_scored) and all_scored[n][1] >= all_scored[0][1] * threshold:
-            n += 1
+            service_ids = [scored[0] for scored in all_scored[:n]]
+            stage['rows'] = n
 
-        return [scored[0] for scored in all_scored[:n]]
+    elif limit is None:
+        with explain.stage('ranking') as stage:
+            all_scored = sorted(scores.items(), key=lambda x: x[1], reverse=True)
+            service_ids = [scored[0] for scored in all_scored[offset:]]
+            stage['rows'] = len(service_ids)
 
     else:
-        return [scored[0] for scored in all_scored]
+        with explain.stage('ranking', limit=limit, offset=offset) as stage:
+            # Solo se ordenan (y se cargan) los servicios hasta la página pedida
+            top_scored = nlargest(offset + limit + 1, scores.items(), key=lambda x: x[1])
+            service_ids = [scored[0] for scored in top_scored[offset:]]
+            stage['rows'] = len(service_ids)
+
+    if facets is not None:
+        with explain.stage('facets') as stage:
+            # Sin search_order solo cuentan los servicios que pasan el umbral
+            facets.collect_ids(ser_table, service_ids if not search_order else scores.keys())
+            stage['rows'] = facets.total
+
+    return service_ids
+
+
+def load_services(ser_table, service_ids, chunk_size=500, options=()):
+    """
+    Loads the services with the given ids keeping the order of the ids
+    :param ser_table: service table
+    :param service_ids: ordered list of ids
+    :param chunk_size: max number of ids per query
+    :param options: loader options of the query (p.e. load_only)
+    :return: list of services
+    """
+    return list(iter_services(ser_table, service_ids, chunk_size, options))
+
+
+def iter_services(ser_table, service_ids, chunk_size=100, options=()):
+    """
+    Loads the services with the given ids chunk by chunk while they are iterated, keeping the order of the ids
+    :param ser_table: service table
+    :param service_ids: ordered list of ids
+    :param chunk_size: number of ids loaded per query
+    :param options: loader options of the query (p.e. load_only)
+    :return: iterator of services
+    """
+    for i in range(0, len(service_ids), chunk_size):
+        chunk = service_ids[i:i + chunk_size]
+        loaded = {s.id: s for s in ser_table.query.options(*options).filter(ser_table.id.in_(chunk))}
+        yield from (loaded[service_id] for service_id in chunk if service_id in loaded)
 
 
 def filter_email_state(q, ser_table, user_email=None):
@@ -212,3 +336,16 @@ def filter_email_state(q, ser_table, user_email=None):
             q_final = q_final.filter(ser_table.state == 0)
 
     return q_final
+
+
+def visibility_class(user_email=None):
+    """
+    Classifies the request maker by the services that filter_email_state lets them see
+    :param user_email: the email of the owner of the services searched, if any
+    :return: 'admin', 'owner' or 'public'
+    """
+    if g.user.access >= 8:
+        return 'admin'
+    if user_email and g.user.email == user_email:
+        return 'owner'
+    return 'public'
@@ -0,0 +1,333 @@
+import atexit
+import os
+import shutil
+import tempfile
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from heapq import nlargest
+from math import log
+from threading import RLock
+
+try:
+    import numpy as np
+except ImportError:  # numpy es opcional, sin él se puntúa con el motor en Python
+    np = None
+
+shard_arrays = ('offsets', 'ids', 'positions', 'counts', 'lengths', 'n_terms', 'doc_ids')
+
+
+class ShardedEngine:
+    """
+    Scoring engine that splits the search index by service id (service_id % n_shards) and scores every shard in
+    a process of a pool. The shards are written as .npy files that the workers memory-map, so the index is not
+    copied into every process. Gives the same scores as the Python scoring loop.
+
+    A query is scored in two rounds: first every shard counts the postings of each word among the candidates,
+    so that the idf is computed with the global counts, and then every shard scores its services and returns its
+    local top k, that are merged by the caller. Services saved after the shards were written are scored in this
+    process from the index, like the delta segment of the sparse engine, until there are enough to rewrite them.
+    """
+
+    def __init__(self, min_delta=1000, delta_ratio=0.1):
+        self.lock = RLock()
+        self.min_delta = min_delta
+        self.delta_ratio = delta_ratio
+        self.n_shards = 0
+        self.pool = None
+        self.generation = 0
+        self.directories = []
+        self.clear()
+
+    @property
+    def available(self):
+        return np is not None
+
+    def clear(self):
+        """
+        Forgets the shards, they will be written again from the index on next use
+        """
+        with self.lock:
+            self.shards = None  # rutas de los shards actuales
+            self.columns = {}  # word -> column
+            self.n_base = 0
+            self.dirty = set()  # servicios modificados después de escribir los shards
+
+    def put(self, service_id, counts):
+        with self.lock:
+            if self.shards is not None:
+                self.dirty.add(service_id)
+
+    def remove(self, service_id):
+        with self.lock:
+            if self.shards is not None:
+                self.dirty.add(service_id)
+
+    def score(self, index, words, candidates, search_order, ranking, n_shards, top_k=None, k1=1.2, b=0.75):
+        """
+        Scores the query words for the candidate services
+        :param index: the search index
+        :param words: query words
+        :param candidates: set with the ids of the services that can be returned
+        :param search_order: if False only the idf of the matched words is added
+        :param ranking: tfidf or bm25
+        :param n_shards: number of shards (and worker processes)
+        :param top_k: if given only the top_k best services of every shard are returned
+        :param k1: BM25 term frequency saturation
+        :param b: BM25 length normalization
+        :return: dict service_id -> score of the matched services
+        """
+        with index.lock, self.lock:
+            self._refresh(index, n_shards)
+
+            # Los servicios modificados se puntúan aquí con el índice, no en los shards
+            delta = candidates & self.dirty
+            shard_candidates = [[] for _ in range(self.n_shards)]
+            for service_id in sorted(candidates - delta):
+                shard_candidates[service_id % self.n_shards].append(service_id)
+            shard_candidates = [np.array(ids, dtype=np.int64) for ids in shard_candidates]
+
+            query = []
+            delta_coincidences = []
+            for word in words:
+                matched_words = [w for w in index.matching_words(word) if w in self.columns]
+                query.append(([self.columns[w] for w in matched_words], [len(word) / len(w) for w in matched_words]))
+                delta_coincidences.append(index.get_coincidences(word, delta) if delta else [])
+
+            shards = self.shards
+            n_active = index.n_active
+            average_terms = index.average_terms() or 1.0
+            documents = {service_id: index.documents[service_id] for service_id in delta if service_id in index.documents}
+
+        # Primera ronda: número de coincidencias de cada palabra en todos los shards
+        rows = [len(coincidences) for coincidences in delta_coincidences]
+        services = [len({service_id for _, service_id, _ in coincidences}) for coincidences in delta_coincidences]
+        for shard_rows, shard_services in self.pool.map(count_shard, shards, [query] * len(shards), shard_candidates):
+            rows = [total + n for total, n in zip(rows, shard_rows)]
+            services = [total + n for total, n in zip(services, shard_services)]
+
+        idfs = []
+        for n_rows, n_services in zip(rows, services):
+            if n_rows == 0:
+                idfs.append(None)
+            elif ranking == 'bm25' and search_order:
+                idfs.append(log(1 + (n_active - n_services + 0.5) / (n_services + 0.5)))
+            else:
+                idfs.append(log(1 + n_active / n_rows))
+
+        # Segunda ronda: cada shard puntúa sus servicios y devuelve sus mejores top_k
+        scores = {}
+        parameters = (search_order, ranking, average_terms, k1, b, top_k)
+        for shard_scores in self.pool.map(score_shard, shards, [query] * len(shards), shard_candidates,
+                                          [idfs] * len(shards), [parameters] * len(shards)):
+            scores.update(shard_scores)
+
+        delta_scores = score_coincidences(words, delta_coincidences, idfs, documents, search_order, ranking,
+                                          average_terms, k1, b)
+        if top_k is not None:
+            delta_scores = dict(nlargest(top_k, delta_scores.items(), key=lambda x: x[1]))
+        scores.update(delta_scores)
+
+        # Ordenados por id, así los empates quedan en el mismo orden que con el motor en Python
+        return dict(sorted(scores.items()))
+
+    def _refresh(self, index, n_shards):
+        if self.pool is None or n_shards != self.n_shards:
+            if self.pool is not None:
+                self.pool.shutdown()
+            self.pool = ProcessPoolExecutor(n_shards)
+            self.n_shards = n_shards
+            self.clear()
+
+        if self.shards is not None and len(self.dirty) > max(self.min_delta, self.delta_ratio * self.n_base):
+            self.clear()
+
+        if self.shards is None:
+            self._write_shards(index)
+
+    def _write_shards(self, index):
+        directory = tempfile.mkdtemp(prefix='search-shards-')
+        self.generation += 1
+
+        words = list(index.postings)
+        self.columns = {word: column for column, word in enumerate(words)}
+        self.n_base = len(index.documents)
+
+        id_arrays = [np.asarray(index.postings[word][0], dtype=np.int64) for word in words]
+        all_ids = np.concatenate(id_arrays) if id_arrays else np.zeros(0, dtype=np.int64)
+        all_counts = np.concatenate([np.asarray(index.postings[word][1], dtype=np.float64) for word in words]) \
+            if words else np.zeros(0)
+        all_columns = np.repeat(np.arange(len(words)), [len(ids) for ids in id_arrays])
+        all_doc_ids = np.array(sorted(index.documents), dtype=np.int64)
+
+        self.shards = []
+        for shard in range(self.n_shards):
+            # Las postings de cada palabra siguen juntas y ordenadas por id después de filtrar
+            mask = all_ids % self.n_shards == shard
+            ids = all_ids[mask]
+            doc_ids = all_doc_ids[all_doc_ids % self.n_shards == shard]
+            documents = [index.documents[int(service_id)] for service_id in doc_ids]
+
+            arrays = {
+                'offsets': np.concatenate(([0], np.cumsum(np.bincount(all_columns[mask], minlength=len(words))))),
+                'ids': ids,
+                'positions': np.searchsorted(doc_ids, ids),
+                'counts': all_counts[mask],
+                'lengths': np.array([document.length for document in documents], dtype=np.float64),
+                'n_terms': np.array([document.n_terms for document in documents], dtype=np.float64),
+                'doc_ids': doc_ids,
+            }
+
+            path = os.path.join(directory, f'{self.generation}-{shard}')
+            os.mkdir(path)
+            for name, array in arrays.items():
+                np.save(os.path.join(path, name + '.npy'), array)
+            self.shards.append(path)
+
+        # Se guardan los shards anteriores por si alguna búsqueda en curso aún los usa
+        self.directories.append(directory)
+        while len(self.directories) > 2:
+            shutil.rmtree(self.directories.pop(0), ignore_errors=True)
+
+    def close(self):
+        """
+        Stops the worker processes and deletes the shard files
+        """
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown()
+                self.pool = None
+            for directory in self.directories:
+                shutil.rmtree(directory, ignore_errors=True)
+            self.directories = []
+            self.clear()
+
+
+# Shards abiertos por el worker, solo se guardan los de la última generación
+opened_shards = {}
+
+
+def open_shard(path):
+    """
+    Memory-maps the arrays of a shard
+    :param path: directory of the shard
+    :return: dict name -> array
+    """
+    if path not in opened_shards:
+        generation = os.path.basename(path).split('-')[0]
+        for old in [old for old in opened_shards if os.path.basename(old).split('-')[0] != generation]:
+            del opened_shards[old]
+        opened_shards[path] = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in shard_arrays}
+    return opened_shards[path]
+
+
+def shard_postings(shard, column, candidates):
+    """
+    :param shard: arrays of the shard
+    :param column: column of the word
+    :param candidates: sorted array with the candidate ids of the shard
+    :return: (positions, counts) of the postings of the word in candidate services
+    """
+    start, end = shard['offsets'][column], shard['offsets'][column + 1]
+    mask = np.isin(shard['ids'][start:end], candidates, assume_unique=True)
+    return shard['positions'][start:end][mask], shard['counts'][start:end][mask]
+
+
+def count_shard(path, query, candidates):
+    """
+    First round: counts the postings (and the services) of every query word among the candidates of a shard
+    :param path: directory of the shard
+    :param query: list of (columns, weights) of every query word
+    :param candidates: sorted array with the candidate ids of the shard
+    :return: (list of number of postings, list of number of services)
+    """
+    shard = open_shard(path)
+    rows, services = [], []
+    for columns, _ in query:
+        positions = [shard_postings(shard, column, candidates)[0] for column in columns]
+        rows.append(sum(len(p) for p in positions))
+        services.append(len(np.unique(np.concatenate(positions))) if positions else 0)
+    return rows, services
+
+
+def score_shard(path, query, candidates, idfs, parameters):
+    """
+    Second round: scores the services of a shard with the global idf of every word
+    :param path: directory of the shard
+    :param query: list of (columns, weights) of every query word
+    :param candidates: sorted array with the candidate ids of the shard
+    :param idfs: idf of every query word, None if the word has no coincidences
+    :param parameters: (search_order, ranking, average_terms, k1, b, top_k)
+    :return: list of (service_id, score) with the top_k services of the shard (all if top_k is None)
+    """
+    search_order, ranking, average_terms, k1, b, top_k = parameters
+    shard = open_shard(path)
+    n_docs = len(shard['doc_ids'])
+    total = np.zeros(n_docs)
+    matched = np.zeros(n_docs, dtype=bool)
+
+    for (columns, weights), idf in zip(query, idfs):
+        if idf is None:
+            continue
+
+        partial = np.zeros(n_docs)
+        present = np.zeros(n_docs, dtype=bool)
+        for column, weight in zip(columns, weights):
+            positions, counts = shard_postings(shard, column, candidates)
+            if ranking == 'bm25':
+                partial[positions] += counts * weight
+            else:
+                partial[positions] += counts / shard['lengths'][positions] * weight
+            present[positions] = True
+
+        if not search_order:
+            total[present] += idf
+        elif ranking == 'bm25':
+            tf = partial[present]
+            length_norm = 1 - b + b * shard['n_terms'][present] / average_terms
+            total[present] += idf * tf * (k1 + 1) / (tf + k1 * length_norm)
+        else:
+            total[present] += np.log(1 + partial[present]) * idf
+        matched |= present
+
+    positions = np.flatnonzero(matched)
+    if top_k is not None and len(positions) > top_k:
+        positions = positions[np.argpartition(-total[positions], top_k - 1)[:top_k]]
+    return [(int(shard['doc_ids'][p]), float(total[p])) for p in positions]
+
+
+def score_coincidences(words, coincidences, idfs, documents, search_order, ranking, average_terms, k1, b):
+    """
+    Scores in this process the services that changed after the shards were written
+    :param words: query words
+    :param coincidences: list with the coincidences (matched word, service_id, count) of every word
+    :param idfs: global idf of every word, None if the word has no coincidences
+    :param documents: dict service_id -> Document
+    :param search_order: if False only the idf of the matched words is added
+    :param ranking: tfidf or bm25
+    :param average_terms: average number of tokens of the indexed services
+    :param k1: BM25 term frequency saturation
+    :param b: BM25 length normalization
+    :return: dict service_id -> score
+    """
+    scores = defaultdict(float)
+    for word, word_coincidences, idf in zip(words, coincidences, idfs):
+        partial_counts = defaultdict(float)
+        for matched_word, service_id, count in word_coincidences:
+            if ranking == 'bm25':
+                partial_counts[service_id] += count * len(word) / len(matched_word)
+            else:
+                partial_counts[service_id] += count / documents[service_id].length * len(word) / len(matched_word)
+
+        for service_id, tf in partial_counts.items():
+            if not search_order:
+                scores[service_id] += idf
+            elif ranking == 'bm25':
+                length_norm = 1 - b + b * documents[service_id].n_terms / average_terms
+                scores[service_id] += idf * tf * (k1 + 1) / (tf + k1 * length_norm)
+            else:
+                scores[service_id] += log(1 + tf) * idf
+    return scores
+
+
+sharded_engine = ShardedEngine()
+atexit.register(sharded_engine.close)
@@ -0,0 +1,185 @@
+from math import log
+from threading import RLock
+
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:  # scipy es opcional, sin él se puntúa con el motor en Python
+    np = sparse = None
+
+
+class Segment:
+    """
+    Part of the corpus stored as a term-major CSR matrix: row i has the counts of the word with column i in the
+    services of the segment, so the words of a query are a row slice. Keeps the normalization vector
+    (1 / text length) of its services and which of them are still alive.
+    """
+
+    def __init__(self, service_ids, rows, columns, counts, n_words, index):
+        self.service_ids = np.asarray(service_ids, dtype=np.int64)
+        self.positions = {service_id: position for position, service_id in enumerate(service_ids)}
+        self.alive = np.ones(len(service_ids), dtype=bool)
+        self.matrix = sparse.csr_matrix((np.asarray(counts, dtype=np.float64), (rows, columns)),
+                                        shape=(n_words, len(service_ids)))
+        self.norm = np.array([1.0 / (index.documents[service_id].length or 1) for service_id in service_ids])
+
+    def kill(self, service_id):
+        """
+        Marks the row of a service as outdated
+        :param service_id: id of the service
+        """
+        position = self.positions.get(service_id)
+        if position is not None:
+            self.alive[position] = False
+
+
+class SparseEngine:
+    """
+    TF-IDF scoring engine that keeps the corpus of the search index as sparse matrices and scores every query
+    word as a sparse matrix-vector product. Gives the same scores as the Python scoring loop.
+
+    The corpus is split in a big base segment and a small delta segment with the services saved since the base
+    was built; the delta is rebuilt when services change and merged into the base when it grows too much.
+    """
+
+    def __init__(self, min_delta=1000, delta_ratio=0.1):
+        self.lock = RLock()
+        self.min_delta = min_delta
+        self.delta_ratio = delta_ratio
+        self.clear()
+
+    @property
+    def available(self):
+        return sparse is not None
+
+    def clear(self):
+        """
+        Drops the matrices, they will be built again from the index on next use
+        """
+        with self.lock:
+            self.base = None
+            self.delta = None
+            self.delta_docs = {}  # service id -> counts of the services modified after building base
+            self.delta_dirty = False
+            self.columns = {}  # word -> column
+
+    def put(self, service_id, counts):
+        with self.lock:
+            if self.base is None:
+                return
+            self.base.kill(service_id)
+            self.delta_docs[service_id] = counts
+            self.delta_dirty = True
+
+    def remove(self, service_id):
+        with self.lock:
+            if self.base is None:
+                return
+            self.base.kill(service_id)
+            self.delta_docs.pop(service_id, None)
+            self.delta_dirty = True
+
+    def refresh(self, index):
+        """
+        Brings the matrices up to date with the index. Must be called with the index locked.
+        :param index: the search index
+        """
+        with self.lock:
+            if self.base is not None and len(self.delta_docs) > max(self.min_delta,
+                                                                   self.delta_ratio * len(self.base.service_ids)):
+                self.clear()
+
+            if self.base is None:
+                self._build_base(index)
+
+            elif self.delta_dirty:
+                self._build_delta(index)
+
+    def score(self, index, words, candidates, search_order):
+        """
+        Scores the query words for the candidate services
+        :param index: the search index
+        :param words: query words
+        :param candidates: set with the ids of the services that can be returned
+        :param search_order: if False only the idf of the matched words is added
+        :return: dict service_id -> score of the matched services
+        """
+        with index.lock, self.lock:
+            self.refresh(index)
+
+            candidate_ids = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+            segments = [segment for segment in (self.base, self.delta) if segment is not None]
+            masks = [segment.alive & np.isin(segment.service_ids, candidate_ids) for segment in segments]
+            totals = [np.zeros(len(segment.service_ids)) for segment in segments]
+            matched = [np.zeros(len(segment.service_ids), dtype=bool) for segment in segments]
+
+            for word in words:
+                matched_words = [w for w in index.matching_words(word) if w in self.columns]
+                columns = np.array([self.columns[w] for w in matched_words], dtype=np.int64)
+                weights = np.array([len(word) / len(w) for w in matched_words])
+
+                n_coincidences = 0
+                partials = []
+                for segment, mask in zip(segments, masks):
+                    in_range = columns < segment.matrix.shape[0]
+                    word_rows = segment.matrix[columns[in_range]]
+
+                    # Número de filas de term_frequency que coinciden, como en el motor en Python
+                    entries = mask[word_rows.indices]
+                    n_coincidences += int(entries.sum())
+
+                    present = np.zeros(len(segment.service_ids), dtype=bool)
+                    present[word_rows.indices[entries]] = True
+                    partial = word_rows.T.dot(weights[in_range]) * segment.norm
+                    partials.append((present, partial))
+
+                if n_coincidences == 0:
+                    continue
+
+                idf = log(1 + index.n_active / n_coincidences)
+                for total, matched_segment, (present, partial) in zip(totals, matched, partials):
+                    if search_order:
+                        total[present] += np.log1p(partial[present]) * idf
+                    else:
+                        total[present] += idf
+                    matched_segment |= present
+
+            scores = {}
+            for segment, total, matched_segment in zip(segments, totals, matched):
+                for position in np.flatnonzero(matched_segment):
+                    scores[int(segment.service_ids[position])] = float(total[position])
+            return scores
+
+    def _build_base(self, index):
+        self.columns = {word: column for column, word in enumerate(index.postings)}
+        service_ids = sorted(index.documents)
+        positions = {service_id: position for position, service_id in enumerate(service_ids)}
+
+        rows, columns, counts = [], [], []
+        for word, (ids, word_counts) in index.postings.items():
+            rows.extend([self.columns[word]] * len(ids))
+            columns.extend(positions[service_id] for service_id in ids)
+            counts.extend(word_counts)
+
+        self.base = Segment(service_ids, rows, columns, counts, len(self.columns), index)
+        self.delta = None
+        self.delta_docs = {}
+        self.delta_dirty = False
+
+    def _build_delta(self, index):
+        service_ids = sorted(self.delta_docs)
+
+        rows, columns, counts = [], [], []
+        for position, service_id in enumerate(service_ids):
+            for word, count in self.delta_docs[service_id]:
+                if word not in self.columns:
+                    self.columns[word] = len(self.columns)
+                rows.append(self.columns[word])
+                columns.append(position)
+                counts.append(count)
+
+        self.delta = Segment(service_ids, rows, columns, counts, len(self.columns), index) if service_ids else None
+        self.delta_dirty = False
+
+
+sparse_engine = SparseEngine()
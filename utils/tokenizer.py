@@ -0,0 +1,30 @@
+import re
+from collections import Counter
+from functools import lru_cache
+
+# Mismo patrón que usábamos con el CountVectorizer de scikit-learn
+token_pattern = r'(?u)[\#]?\b\w\w+\b'
+token_regex = re.compile(token_pattern)
+
+
+def tokenize(s: str):
+    """
+    Splits a text in tokens and counts them. Gives the same tokens and counts as
+    CountVectorizer(token_pattern=token_pattern) without building any matrix.
+    :param s: text to tokenize
+    :return: list of (token, count) sorted by token
+    """
+    return sorted(Counter(token_regex.findall(s.lower())).items())
+
+
+@lru_cache(maxsize=4096)
+def tokenize_search(s: str):
+    """
+    Tokenizes a search text. Results are cached as the same searches are repeated a lot.
+    :param s: search text
+    :return: tuple with the sorted words and the sorted hashtags of the text
+    """
+    tokens = sorted(set(token_regex.findall(s.lower())))
+    words = tuple(t for t in tokens if t[0] != '#')
+    hashtags = tuple(t for t in tokens if t[0] == '#')
+    return words, hashtags